@@ -1,73 +1,255 @@
-import traceback
-from typing import Self
+import logging
 import os
-from flask import Flask, render_template, render_template_string, request, jsonify, g, current_app, redirect, url_for, send_file
+from quart import Quart, Response, render_template, request, jsonify, g, redirect, url_for, send_file
 from dotenv import load_dotenv
 from db import db
 import asyncio
-import nest_asyncio
 import audiogen
+import audiobook
 import chapter
+import fragments
 import story
 import storage
 import migrate_storage
-from io import BytesIO
-from pydub import AudioSegment
-import tempfile
+import migrate
+import read_cache
+import gateway
+import jobs
+import metrics
+import tracing
+import json
+import time
 
 load_dotenv()
-nest_asyncio.apply()
+tracing.configure_logging()
 
-app = Flask(__name__)
-app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev")
+logger = logging.getLogger(__name__)
 
-def get_db():
+# An ASGI app: each server worker process runs one long-lived event loop, e.g.
+#   hypercorn --workers 4 --bind 0.0.0.0:5000 app:app
+app = Quart(__name__)
+app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev")
+# Chapters stream for minutes; don't cut the response off
+app.config["RESPONSE_TIMEOUT"] = None
+
+# Background workers for long-running generation; also resumes interrupted jobs
+job_queue = jobs.JobQueue(db)
+
+@app.before_serving
+async def startup():
+    # Apply pending schema migrations once at startup; deploys can run
+    # `python migrate.py` instead and set MIGRATE_ON_STARTUP=0
+    if os.getenv("MIGRATE_ON_STARTUP", "1") == "1":
+        await migrate.run_migrations(db)
+    await job_queue.start()
+    fragments.preload(app.jinja_env)
+
+@app.after_serving
+async def shutdown():
+    await job_queue.stop()
+    await gateway.close()
+    await db.close()
+
+# Versioned audio URLs never change content, so browsers may cache them for good
+AUDIO_MAX_AGE = int(os.getenv("AUDIO_MAX_AGE", str(365 * 24 * 3600)))
+# Set (e.g. to "/protected-audio") when nginx serves USER_DATA_DIR as an internal location
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX")
+# Apache/lighttpd equivalent: send an X-Sendfile header with the file's path
+USE_X_SENDFILE = os.getenv("USE_X_SENDFILE", "0") == "1"
+
+@app.template_global()
+async def audio_url(story_id, chapter_number=None):
+    """URL for chapter (or audiobook) audio, versioned by the file's size and mtime."""
+    if chapter_number is None:
+        version = await storage.get_audiobook_version_async(story_id)
+        url = f"/api/stories/{story_id}/audiobook"
+    else:
+        version = await storage.get_chapter_audio_version_async(story_id, chapter_number)
+        url = f"/api/stories/{story_id}/chapters/{chapter_number}/audio"
+    return f"{url}?v={version}" if version else url
+
+@app.template_global()
+async def audio_info(story_id, chapter_number=None):
+    """Length and format of chapter (or audiobook) audio, as probed when it was saved."""
+    if chapter_number is None:
+        return await storage.get_audiobook_info_async(story_id)
+    return await storage.get_chapter_audio_info_async(story_id, chapter_number)
+
+@app.template_filter()
+def duration(ms):
+    """Milliseconds as m:ss."""
+    if ms is None:
+        return ""
+    seconds = round(ms / 1000)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+async def send_audio(path):
+    """Serve an MP3 from disk with Range, ETag/Last-Modified and cache headers.
+
+    Returns None if the file doesn't exist.
+    """
+    if not path.exists():
+        return None
+
+    if X_ACCEL_REDIRECT_PREFIX:
+        # Hand the transfer (ranges, validators) to nginx
+        response = Response("", mimetype="audio/mpeg")
+        relative = path.relative_to(storage.get_user_data_dir()).as_posix()
+        response.headers["X-Accel-Redirect"] = f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{relative}"
+    elif USE_X_SENDFILE:
+        response = Response("", mimetype="audio/mpeg")
+        response.headers["X-Sendfile"] = str(path.resolve())
+    else:
+        # send_file streams the file in blocks without holding up the loop,
+        # and answers Range and If-None-Match/If-Modified-Since requests itself
+        response = await send_file(path, mimetype="audio/mpeg", conditional=True)
+
+    if request.args.get("v") == storage.get_file_version(path):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = AUDIO_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # The URL's content can change, so drop send_file's public max-age too
+        response.cache_control.public = False
+        response.cache_control.max_age = None
+        response.cache_control.no_cache = True
+    return response
+
+async def send_fragment(key, render):
+    """Serve a rendered fragment from the fragment cache, tagged for revalidation.
+
+    render is only called on a cache miss; a client that already has this
+    version gets a 304 without the fragment being looked up at all.
+    """
+    etag = fragments.etag(key)
+    if request.if_none_match.contains(etag):
+        return tagged_response(etag)
+    html = fragments.get(key)
+    if html is None:
+        html = await render()
+        fragments.put(key, html)
+    return tagged_response(etag, html)
+
+async def send_cached_page(key, render):
+    """Serve a page from the read cache, tagged for revalidation.
+
+    Entries are keyed by a version every write to the story bumps on disk
+    (see read_cache), so all worker processes see a write at once, and
+    expire after READ_CACHE_TTL; until then repeat views, and 304s, skip
+    the database. render returns the page and whether it may be cached.
+    """
+    loaded_at = read_cache.version(key)
+    etag = read_cache.etag(key, loaded_at)
+    if request.if_none_match.contains(etag):
+        return tagged_response(etag)
+    entry = read_cache.get(key, loaded_at)
+    if entry is not None:
+        return tagged_response(etag, entry.value)
+    html, cacheable = await render()
+    if not cacheable:
+        # e.g. the database was down and the page shows nothing; don't keep it or tag it
+        response = Response(html)
+        response.cache_control.no_store = True
+        return response
+    return tagged_response(etag, read_cache.put(key, html, loaded_at).value)
+
+def tagged_response(etag, html=None):
+    """html with an ETag the browser must revalidate with; a 304 if html is None."""
+    response = Response(html) if html is not None else Response("", status=304)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+async def get_db():
+    """Check out one pooled database session for the current request."""
     if not hasattr(g, '_database'):
-        g._database = db
+        g._database = await db.acquire()
     return g._database
 
+@app.before_request
+async def start_timer():
+    g._request_start = time.perf_counter()
+    # Each request is a trace; spans opened while handling it nest under this one
+    g._request_span = tracing.start(
+        f"{request.method} {request.endpoint or 'unknown'}",
+        tracing.KIND_SERVER,
+        http_method=request.method,
+        http_route=request.url_rule.rule if request.url_rule else None,
+        story_id=(request.view_args or {}).get('story_id'),
+        chapter_number=(request.view_args or {}).get('chapter_number'),
+    )
+
+@app.after_request
+async def record_request_time(response):
+    if hasattr(g, '_request_start'):
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - g._request_start,
+            endpoint=request.endpoint or 'unknown',
+            method=request.method,
+            status=response.status_code
+        )
+    if hasattr(g, '_request_span'):
+        g._request_span.set(http_status_code=response.status_code)
+    return response
+
+@app.teardown_request
+async def finish_request_span(error):
+    if hasattr(g, '_request_span'):
+        tracing.finish(g.pop('_request_span'), error)
+
+@app.route("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.teardown_appcontext
-def close_db(error):
+async def release_db(error):
     if hasattr(g, '_database'):
-        current_app.ensure_sync(g._database.close)()
+        db.release(g.pop('_database'))
 
 @app.route("/")
 async def home():
-    stories = await story.get_recent_stories(db)
-    return render_template("home.html", stories=stories)
+    async def render():
+        stories = await story.get_recent_stories(await get_db())
+        html = await render_template("home.html", stories=stories or [])
+        return html, stories is not None
+
+    return await send_cached_page(read_cache.HOME, render)
 
 @app.route("/story-builder")
 async def story_builder():
-    return render_template("story_builder.html")
+    return await render_template("story_builder.html")
 
 @app.route("/stories/<story_id>/edit")
 async def edit_story(story_id):
-    story_data = await story.get_story(db, story_id)
+    story_data = await story.get_story_with_chapters(await get_db(), story_id)
     if not story_data:
         return "Story not found", 404
 
-    chapters = await story.get_story_chapters(db, story_id)
-    return render_template(
+    return await render_template(
         "story_editor.html",
         story=story_data,
-        chapters=chapters
+        chapters=story_data["chapters"]
     )
 
 @app.route("/api/stories", methods=["POST"])
 async def create_story_endpoint():
-    prompt = request.form.get("prompt", "").strip()
-    total_chapters = int(request.form.get("total_chapters", 10))
-    words_per_chapter = int(request.form.get("words_per_chapter", 1000))
+    form = await request.form
+    prompt = form.get("prompt", "").strip()
+    total_chapters = int(form.get("total_chapters", 10))
+    words_per_chapter = int(form.get("words_per_chapter", 1000))
+    context_tokens = int(form.get("context_tokens", chapter.CONTEXT_TOKEN_BUDGET))
 
     if not prompt:
         return "Prompt is required", 400
 
     try:
         story_id, error = await story.create_story(
-            db, 
+            await get_db(), 
             prompt=prompt,
             total_chapters=total_chapters,
-            words_per_chapter=words_per_chapter
+            words_per_chapter=words_per_chapter,
+            context_tokens=context_tokens
         )
         
         if error:
@@ -76,289 +258,245 @@ async def create_story_endpoint():
         return redirect(url_for('edit_story', story_id=story_id))
 
     except Exception as e:
-        print("Error in create_story_endpoint:", e)
-        traceback.print_exc()
+        logger.exception("Error in create_story_endpoint")
         return f"Error creating story: {str(e)}", 500
 
 @app.route("/api/stories/<story_id>", methods=["DELETE"])
 async def delete_story_endpoint(story_id):
     try:
-        success, error = await story.delete_story(db, story_id)
+        success, error = await story.delete_story(await get_db(), story_id)
         if not success:
             return f"Error deleting story: {error}", 500
         return "", 204
 
     except Exception as e:
-        print("Error in delete_story_endpoint:", e)
+        logger.error("Error in delete_story_endpoint: %s", e)
         return f"Error deleting story: {str(e)}", 500
 
 @app.route("/api/stories/<story_id>/chapters", methods=["POST"])
 async def generate_chapter_endpoint(story_id):
-    chapter_number = int(request.form.get("chapter_number", 1))
+    chapter_number = int((await request.form).get("chapter_number", 1))
 
     try:
-        content = await chapter.generate_new_chapter(db, story_id, chapter_number)
+        # Shielded, so the chapter is still saved if the browser goes away
+        content = await asyncio.shield(
+            job_queue.run(chapter.generate_new_chapter(db, story_id, chapter_number))
+        )
         return content
 
     except Exception as e:
-        print("Error in generate_chapter_endpoint:", e)
+        logger.error("Error in generate_chapter_endpoint: %s", e)
         raise
 
+@app.route("/api/stories/<story_id>/chapters/<int:chapter_number>/stream", methods=["POST"])
+async def stream_chapter_endpoint(story_id, chapter_number):
+    """Generate a chapter, pushing markdown to the browser as server-sent events."""
+    events = asyncio.Queue()
+
+    async def produce():
+        try:
+            async for text in chapter.stream_new_chapter(db, story_id, chapter_number):
+                events.put_nowait(("token", text))
+            events.put_nowait(("done", chapter_number))
+        except Exception as e:
+            logger.error("Error in stream_chapter_endpoint: %s", e)
+            events.put_nowait(("error", str(e)))
+
+    # Generation runs as its own task, so the chapter is still saved
+    # if the browser goes away before the stream ends
+    job_queue.run(produce())
+
+    async def generate():
+        while True:
+            event, data = await events.get()
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            if event != "token":
+                return
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
 @app.route("/api/stories/<story_id>/chapters/<int:chapter_number>/audio", methods=["POST"])
 async def generate_chapter_audio_endpoint(story_id, chapter_number):
     # Get chapter content
-    chapter_text = storage.get_chapter_text(story_id, chapter_number)
+    chapter_text = await storage.get_chapter_text_async(story_id, chapter_number)
     if not chapter_text:
         return jsonify({"error": "Chapter not found"}), 404
     
-    print(f"Generating audio for chapter {chapter_number} (text length: {len(chapter_text)})")
-    
-    # Generate audio
-    audio_bytes = await audiogen.generate_audio(chapter_text)
-    print(f"Generated audio length: {len(audio_bytes)} bytes")
+    async def record():
+        audio_bytes = await audiogen.generate_audio(chapter_text, story_id, chapter_number)
+
+        # Save to filesystem, with its size and length on the chapter
+        await chapter.save_chapter_audio(db, story_id, chapter_number, audio_bytes)
+        logger.info("Saved audio for chapter %s of %s", chapter_number, story_id,
+                    extra={'text_length': len(chapter_text), 'bytes': len(audio_bytes)})
+        await storage.run_io(audiobook.refresh_audiobook, story_id)
 
-    # Save to filesystem
-    storage.save_chapter_audio(story_id, chapter_number, audio_bytes)
-    print(f"Saved audio file for chapter {chapter_number}")
+    # Shielded, so paid-for audio is still saved if the browser goes away
+    await asyncio.shield(job_queue.run(record()))
     
     # Return the audio player HTML
-    return render_template_string('''
-        <audio id="chapter-audio" controls>
-            <source src="/api/stories/{{ story_id }}/chapters/{{ chapter_number }}/audio" type="audio/mp3">
-            Your browser does not support the audio element.
-        </audio>
-    ''', story_id=story_id, chapter_number=chapter_number)
+    return await render_template(fragments.FRAGMENTS['chapter_audio'], story_id=story_id, chapter_number=chapter_number)
 
 @app.route("/api/stories/<story_id>/chapters/<int:chapter_number>/audio")
 async def get_chapter_audio_endpoint(story_id, chapter_number):
-    audio_bytes = storage.get_chapter_audio(story_id, chapter_number)
-    if not audio_bytes:
+    response = await send_audio(storage.get_chapter_audio_path(story_id, chapter_number))
+    if response is None:
         return "No audio found", 404
-    
-    # Return as streaming audio
-    return send_file(
-        BytesIO(audio_bytes),
-        mimetype='audio/mp3'
-    )
+    return response
 
 @app.route("/api/stories/<story_id>/chapters-list")
 async def get_chapters_list_endpoint(story_id):
-    chapters, num_chapters = await chapter.get_chapters_list(db, story_id)
-    if chapters is None:
-        return "Story not found", 404
+    async def render():
+        story_data = await story.get_story_with_chapters(await get_db(), story_id)
+        if not story_data:
+            raise ValueError(f"Story not found: {story_id}")
 
-    # Check if audiobook exists
-    has_audiobook = storage.has_audiobook(story_id)
-    print(f"Checking audiobook for {story_id}: {has_audiobook}")
+        # Check if audiobook exists
+        has_audiobook = await storage.has_audiobook_async(story_id)
 
-    return render_template(
-        "chapters_list.html",
-        story_id=story_id,
-        chapters=chapters,
-        num_chapters=num_chapters,
-        has_audiobook=has_audiobook
-    )
+        html = await render_template(
+            "chapters_list.html",
+            story_id=story_id,
+            chapters=story_data["chapters"],
+            num_chapters=story_data["num_chapters"],
+            has_audiobook=has_audiobook
+        )
+        return html, True
+
+    return await send_cached_page(read_cache.chapters_list_key(story_id), render)
 
 @app.route("/api/stories/<story_id>/title", methods=["PUT"])
 async def update_story_title_endpoint(story_id):
     try:
-        title = request.form.get("title", "").strip()
+        title = (await request.form).get("title", "").strip()
         if not title:
             return "Title is required", 400
 
-        if not await chapter.update_story_title(db, story_id, title):
+        if not await chapter.update_story_title(await get_db(), story_id, title):
             return "Failed to update title", 500
 
-        return render_template_string('''
-            <div class="title-display" hx-target="this" hx-swap="outerHTML">
-                <h1>{{ title }}</h1>
-                <button class="edit-btn" onclick="this.closest('.title-display').querySelector('h1').click()">
-                    <svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="18" height="18">
-                        <path fill="none" d="M0 0h24v24H0z"/>
-                        <path fill="currentColor" d="M3 17.25V21h3.75L17.81 9.94l-3.75-3.75L3 17.25zM20.71 7.04c.39-.39.39-1.02 0-1.41l-2.34-2.34c-.39-.39-1.02-.39-1.41 0l-1.83 1.83 3.75 3.75 1.83-1.83z"/>
-                    </svg>
-                </button>
-            </div>
-        ''', title=title)
+        return await render_template(fragments.FRAGMENTS['story_title'], title=title)
 
     except Exception as e:
-        print("Error updating story title:", e)
+        logger.error("Error updating story title: %s", e)
         return f"Error updating title: {str(e)}", 500
 
 @app.route("/api/stories/<story_id>/chapters/<int:chapter_number>")
 async def get_chapter_endpoint(story_id, chapter_number):
-    content = storage.get_chapter_text(story_id, chapter_number)
-    if not content:
+    files = await storage.get_chapter_files_async(story_id, chapter_number)
+    if 'text' not in files:
         raise ValueError(f"Chapter not found: {story_id} #{chapter_number}")
 
-    has_audio = storage.has_chapter_audio(story_id, chapter_number)
-    print(f"Rendering chapter {chapter_number} for story {story_id}; has_audio: {has_audio}")
-    
-    return render_template_string('''
-        <div class="chapter-controls">
-            {% if has_audio %}
-                <audio id="chapter-audio" controls>
-                    <source src="/api/stories/{{ story_id }}/chapters/{{ chapter_number }}/audio" type="audio/mp3">
-                    Your browser does not support the audio element.
-                </audio>
-            {% else %}
-                <button id="generate-audio-btn" 
-                        hx-post="/api/stories/{{ story_id }}/chapters/{{ chapter_number }}/audio"
-                        hx-swap="outerHTML"
-                        _="on htmx:beforeRequest 
-                           add .hidden to <button#generate-audio-btn/>
-                           remove .hidden from <div#audio-loading/>">
-                    <svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24">
-                        <path fill="none" d="M0 0h24v24H0z"/>
-                        <path fill="currentColor" d="M12 3v10.55c-.59-.34-1.27-.55-2-.55-2.21 0-4 1.79-4 4s1.79 4 4 4 4-1.79 4-4V7h4V3h-6z"/>
-                    </svg>
-                    Generate Audio
-                </button>
-                <div id="audio-loading" class="loading hidden">
-                    <div class="loading-spinner"></div>
-                    <span>Generating audio...</span>
-                </div>
-            {% endif %}
-        </div>
-        <div class="chapter-content">{{ content | safe }}</div>
-    ''', 
-    content=content,
-    has_audio=has_audio,
-    story_id=story_id,
-    chapter_number=chapter_number
-    )
+    async def render():
+        content = await storage.get_chapter_text_async(story_id, chapter_number)
+        if not content:
+            raise ValueError(f"Chapter not found: {story_id} #{chapter_number}")
+        return await render_template(
+            fragments.FRAGMENTS['chapter'],
+            content=content,
+            has_audio='audio' in files,
+            story_id=story_id,
+            chapter_number=chapter_number
+        )
+
+    return await send_fragment(fragments.chapter_key(story_id, chapter_number, files), render)
 
 @app.route("/api/stories/<story_id>/generate-all", methods=["POST"])
 async def generate_all_endpoint(story_id):
     try:
         # Get story details
-        story_data = await story.get_story(db, story_id)
+        story_data = await story.get_story(await get_db(), story_id)
         if not story_data:
             return "Story not found", 404
 
-        # Generate all remaining chapters
-        chapters, num_chapters = await chapter.get_chapters_list(db, story_id)
-        current_chapters = len(chapters)
-        
-        for chapter_num in range(current_chapters + 1, num_chapters + 1):
-            print(f"Generating chapter {chapter_num}")
-            content = await chapter.generate_new_chapter(db, story_id, chapter_num)
-            
-            # Generate audio for this chapter
-            print(f"Generating audio for chapter {chapter_num}")
-            audio_bytes = await audiogen.generate_audio(content)
-            storage.save_chapter_audio(story_id, chapter_num, audio_bytes)
-        
-        # Generate audio for any existing chapters that don't have it
-        for chapter_num in range(1, current_chapters + 1):
-            if not storage.has_chapter_audio(story_id, chapter_num):
-                print(f"Generating missing audio for chapter {chapter_num}")
-                content = storage.get_chapter_text(story_id, chapter_num)
-                audio_bytes = await audiogen.generate_audio(content)
-                storage.save_chapter_audio(story_id, chapter_num, audio_bytes)
-        
-        # Return the last chapter's content
-        content = storage.get_chapter_text(story_id, num_chapters)
-        has_audio = storage.has_chapter_audio(story_id, num_chapters)
-        
-        return render_template_string('''
-            <div class="chapter-controls">
-                {% if has_audio %}
-                    <audio id="chapter-audio" controls>
-                        <source src="/api/stories/{{ story_id }}/chapters/{{ chapter_number }}/audio" type="audio/mp3">
-                        Your browser does not support the audio element.
-                    </audio>
-                {% endif %}
-            </div>
-            <div class="chapter-content">{{ content | safe }}</div>
-        ''', 
-        content=content,
-        has_audio=has_audio,
-        story_id=story_id,
-        chapter_number=num_chapters
-        )
+        # Reuse the story's active job rather than racing a second one
+        job, created = await jobs.start_job(await get_db(), story_id)
+        if created:
+            job_queue.submit(job)
+            logger.info("Queued generate-all job %s for story %s", job['id'], story_id)
+
+        return await render_template("job_status.html", job=job)
 
     except Exception as e:
-        print("Error in generate_all_endpoint:", e)
+        logger.error("Error in generate_all_endpoint: %s", e)
         raise
 
+@app.route("/api/jobs/<job_id>")
+async def get_job_endpoint(job_id):
+    job = await jobs.get_job(await get_db(), job_id)
+    if not job:
+        return "Job not found", 404
+    return await render_template("job_status.html", job=job)
+
+@app.route("/api/jobs/<job_id>", methods=["DELETE"])
+async def cancel_job_endpoint(job_id):
+    await jobs.cancel_job(await get_db(), job_id)
+    job_queue.cancel(job_id)
+
+    job = await jobs.get_job(await get_db(), job_id)
+    if not job:
+        return "Job not found", 404
+    return await render_template("job_status.html", job=job)
+
 @app.route("/api/stories/<story_id>/audiobook", methods=["POST"])
 async def generate_audiobook_endpoint(story_id):
     try:
         # Get all chapters
-        chapters, num_chapters = await chapter.get_chapters_list(db, story_id)
+        chapters, num_chapters = await chapter.get_chapters_list(await get_db(), story_id)
         if not chapters:
             return "No chapters found", 404
 
         # Check if all chapters have audio
-        for chapter_num in range(1, num_chapters + 1):
-            if not storage.has_chapter_audio(story_id, chapter_num):
-                return "Not all chapters have audio generated", 400
-
-        print(f"Generating audiobook for story {story_id}")
-        
-        # Concatenate all audio files
-        combined = AudioSegment.empty()
-        for chapter_num in range(1, num_chapters + 1):
-            audio_bytes = storage.get_chapter_audio(story_id, chapter_num)
-            print(f"Adding chapter {chapter_num} audio ({len(audio_bytes)} bytes)")
-            
-            # Save bytes to temp file because pydub needs a file
-            with tempfile.NamedTemporaryFile(suffix='.mp3') as temp_file:
-                temp_file.write(audio_bytes)
-                temp_file.flush()
-                
-                # Load the audio and add it to combined
-                audio_segment = AudioSegment.from_mp3(temp_file.name)
-                if len(combined) > 0:
-                    # Add 1 second of silence between chapters
-                    combined += AudioSegment.silent(duration=1000)
-                combined += audio_segment
-
-        # Export combined audio to bytes
-        with tempfile.NamedTemporaryFile(suffix='.mp3') as temp_file:
-            combined.export(temp_file.name, format='mp3')
-            temp_file.seek(0)
-            final_audio_bytes = temp_file.read()
-
-        print(f"Saving audiobook ({len(final_audio_bytes)} bytes)")
-        # Save to disk
-        storage.save_audiobook(story_id, final_audio_bytes)
+        chapter_files = await asyncio.gather(*(
+            storage.get_chapter_files_async(story_id, n) for n in range(1, num_chapters + 1)
+        ))
+        if not all('audio' in files for files in chapter_files):
+            return "Not all chapters have audio generated", 400
+
+        # Chapters in different formats can't be joined frame by frame
+        formats = {(info.sample_rate, info.channels) for info in (
+            storage.audio_info(files['audio']) for files in chapter_files
+        ) if info}
+
+        # Stream chapters into the audiobook file; unchanged chapters are kept
+        try:
+            if len(formats) > 1:
+                raise ValueError("Chapters were recorded in different formats")
+            manifest = await storage.run_io(audiobook.build_audiobook, story_id, list(range(1, num_chapters + 1)))
+            logger.info("Audiobook for %s ready (%d chapters)", story_id, len(manifest['chapters']))
+        except ValueError as e:
+            logger.info("Rebuilding audiobook by re-encoding: %s", e)
+            chapter_audio = await asyncio.gather(*(
+                storage.get_chapter_audio_async(story_id, n) for n in range(1, num_chapters + 1)
+            ))
+            audio_bytes = await storage.run_io(audiogen.join_mp3, list(chapter_audio), audiobook.CHAPTER_GAP_MS)
+            await storage.run_io(audiobook.replace_audiobook, story_id, audio_bytes)
 
         # Return audio player HTML
-        return render_template_string('''
-            <audio id="audiobook-player" controls>
-                <source src="/api/stories/{{ story_id }}/audiobook" type="audio/mp3">
-                Your browser does not support the audio element.
-            </audio>
-        ''', story_id=story_id)
+        return await render_template(fragments.FRAGMENTS['audiobook_player'], story_id=story_id)
 
     except Exception as e:
-        print("Error creating audiobook:", e)
-        traceback.print_exc()
+        logger.exception("Error creating audiobook")
         return f"Error creating audiobook: {str(e)}", 500
 
 @app.route("/api/stories/<story_id>/audiobook", methods=["GET"])
 async def get_audiobook_endpoint(story_id):
     try:
-        audio_bytes = storage.get_audiobook(story_id)
-        if not audio_bytes:
+        response = await send_audio(storage.get_audiobook_path(story_id))
+        if response is None:
             return "Audiobook not found", 404
-
-        # Return as streamable audio
-        return send_file(
-            BytesIO(audio_bytes),
-            mimetype='audio/mp3'
-        )
+        return response
 
     except Exception as e:
-        print("Error serving audiobook:", e)
-        traceback.print_exc()
+        logger.exception("Error serving audiobook")
         return f"Error serving audiobook: {str(e)}", 500
 
 @app.route('/favicon.ico')
-def favicon():
-    return app.send_static_file('images/favicon.png')
+async def favicon():
+    return await app.send_static_file('images/favicon.png')
 
 if __name__ == "__main__":
     app.run(debug=True) 
\ No newline at end of file
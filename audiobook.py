@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import struct
+from typing import Any, Dict, List, Optional
+import metrics
+import mp3
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Silence between chapters
+CHAPTER_GAP_MS = 1000
+
+# Space reserved at the start of the file for the ID3 chapter tag, so that
+# markers can be rewritten in place without moving any audio
+ID3_RESERVED = 8192
+
+MANIFEST_VERSION = 1
+
+
+def load_manifest(story_id: str) -> Optional[Dict[str, Any]]:
+    path = storage.get_audiobook_manifest_path(story_id)
+    if not path.exists() or not storage.get_audiobook_path(story_id).exists():
+        return None
+    try:
+        manifest = json.loads(path.read_text(encoding='utf-8'))
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable audiobook manifest for %s: %s", story_id, e)
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(story_id: str, manifest: Dict[str, Any]) -> None:
+    """Write the manifest atomically so it always matches a consistent file prefix."""
+    storage.write_atomic(storage.get_audiobook_manifest_path(story_id), json.dumps(manifest, indent=2).encode('utf-8'))
+
+
+def source_stamp(story_id: str, chapter_number: int) -> Dict[str, int]:
+    """What identifies one version of a chapter's audio file."""
+    stat = storage.get_chapter_audio_path(story_id, chapter_number).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def id3_frame(frame_id: bytes, body: bytes) -> bytes:
+    return frame_id + struct.pack('>IH', len(body), 0) + body
+
+
+def id3_chapter_tag(chapters: List[Dict[str, Any]]) -> bytes:
+    """An ID3v2.3 tag with CHAP/CTOC frames, padded to ID3_RESERVED bytes."""
+    frames = []
+    element_ids = []
+    for entry in chapters:
+        element_id = f"ch{entry['chapter_number']}".encode('latin-1')
+        element_ids.append(element_id)
+        title = id3_frame(b'TIT2', b'\x00' + f"Chapter {entry['chapter_number']}".encode('latin-1'))
+        frames.append(id3_frame(b'CHAP', element_id + b'\x00' + struct.pack(
+            '>IIII', entry["start_ms"], entry["end_ms"], 0xFFFFFFFF, 0xFFFFFFFF
+        ) + title))
+    toc = b'toc\x00' + bytes([0x03, len(element_ids)]) + b''.join(e + b'\x00' for e in element_ids)
+    frames.insert(0, id3_frame(b'CTOC', toc))
+
+    body = b''.join(frames)
+    size = ID3_RESERVED - 10
+    if len(body) > size:
+        raise ValueError(f"Chapter tag needs {len(body)} bytes; only {size} reserved")
+    synchsafe = bytes([(size >> shift) & 0x7F for shift in (21, 14, 7, 0)])
+    return b'ID3\x03\x00\x00' + synchsafe + body + bytes(size - len(body))
+
+
+def build_audiobook(story_id: str, chapter_numbers: List[int]) -> Dict[str, Any]:
+    """Bring the story's audiobook up to date with its chapter audio.
+
+    Chapters are streamed into the output file one at a time. Chapters whose
+    audio hasn't changed since the last build are kept as they are: the file
+    is cut back to the first changed chapter and only the rest is appended.
+    Returns the manifest, which records each chapter's position and times.
+    Builds of one story take turns, across threads and worker processes.
+    """
+    with storage.story_lock(story_id, 'audiobook'):
+        return write_audiobook(story_id, chapter_numbers)
+
+
+@metrics.AUDIO_PROCESS_SECONDS.time(operation='audiobook')
+def write_audiobook(story_id: str, chapter_numbers: List[int]) -> Dict[str, Any]:
+    """build_audiobook's work, with the story's audiobook lock held."""
+    if not chapter_numbers:
+        raise ValueError("No chapters to build an audiobook from")
+
+    path = storage.prepare_write(storage.get_audiobook_path(story_id))
+    manifest = load_manifest(story_id)
+
+    # Keep the longest prefix of chapters whose audio is unchanged
+    kept: List[Dict[str, Any]] = []
+    if manifest:
+        for entry, chapter_number in zip(manifest["chapters"], chapter_numbers):
+            if entry["chapter_number"] != chapter_number or entry["source"] != source_stamp(story_id, chapter_number):
+                break
+            kept.append(entry)
+        if len(kept) == len(chapter_numbers) == len(manifest["chapters"]):
+            logger.debug("Audiobook for %s is up to date", story_id)
+            return manifest
+
+    header = mp3.FrameHeader(**manifest["format"]) if manifest and kept else None
+    audio_start = ID3_RESERVED + (mp3.xing_header(header).length if header else 0)
+    end = kept[-1]["offset"] + kept[-1]["length"] if kept else audio_start
+
+    # Record the truncation first so a crash mid-append leaves a valid prefix
+    if manifest:
+        manifest["chapters"] = kept
+        save_manifest(story_id, manifest)
+
+    try:
+        mode = 'r+b' if kept else 'w+b'
+        with open(path, mode) as out:
+            out.truncate(end)
+            out.seek(end)
+
+            chapters = list(kept)
+            for chapter_number in chapter_numbers[len(kept):]:
+                audio_path = storage.get_chapter_audio_path(story_id, chapter_number)
+                source = source_stamp(story_id, chapter_number)
+                data = audio_path.read_bytes()
+                frames = list(mp3.iter_frames(data))
+                if not frames:
+                    raise ValueError(f"No MP3 audio in chapter {chapter_number}")
+
+                if header is None:
+                    header = frames[0][1]
+                    audio_start = ID3_RESERVED + mp3.xing_header(header).length
+                    out.seek(audio_start)
+                    end = audio_start
+
+                offset = end
+                frame_count = 0
+                bitrates = set()
+                if chapters:
+                    silence = mp3.silence_frame(header)
+                    count = mp3.silence_frame_count(header, CHAPTER_GAP_MS)
+                    out.write(silence * count)
+                    frame_count += count
+                    bitrates.add(header.bitrate)
+
+                for frame_offset, frame_header in frames:
+                    if frame_header.stream_format != header.stream_format:
+                        raise ValueError(f"Chapter {chapter_number} audio has a different format")
+                    out.write(data[frame_offset:frame_offset + frame_header.length])
+                    frame_count += 1
+                    bitrates.add(frame_header.bitrate)
+                end = out.tell()
+
+                start_ms = chapters[-1]["end_ms"] if chapters else 0
+                chapters.append({
+                    "chapter_number": chapter_number,
+                    "source": source,
+                    "offset": offset,
+                    "length": end - offset,
+                    "frames": frame_count,
+                    "bitrates": sorted(bitrates),
+                    "start_ms": start_ms,
+                    "end_ms": start_ms + frame_count * header.samples * 1000 // header.sample_rate,
+                })
+                logger.debug("Added chapter %s to audiobook (%d bytes)", chapter_number, end - offset)
+
+            # Headers go last, once the totals are known
+            spans = [(entry["frames"], entry["length"]) for entry in chapters]
+            vbr = len({rate for entry in chapters for rate in entry["bitrates"]}) > 1
+            out.seek(0)
+            out.write(id3_chapter_tag(chapters))
+            out.write(mp3.xing_frame(header, spans, vbr))
+            out.flush()
+            os.fsync(out.fileno())
+    except Exception:
+        # A half-written book is worse than none; the next build starts over
+        storage.get_audiobook_manifest_path(story_id).unlink(missing_ok=True)
+        path.unlink(missing_ok=True)
+        storage.record_file(story_id, None, 'audiobook')
+        raise
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "format": {
+            "version": header.version,
+            "bitrate_index": header.bitrate_index,
+            "sample_rate_index": header.sample_rate_index,
+            "padding": 0,
+            "channel_mode": header.channel_mode,
+            "mode_extension": 0,
+            "protected": False,
+        },
+        "chapters": chapters,
+    }
+    save_manifest(story_id, manifest)
+    storage.record_file(story_id, None, 'audiobook', mp3.probe_file(path))
+    return manifest
+
+
+def replace_audiobook(story_id: str, audio_data: bytes) -> None:
+    """Save an audiobook made some other way (re-encoded), in place of a frame-level build.
+
+    The old build's manifest goes first: it describes offsets in the file
+    being replaced, and the next refresh would otherwise splice into them.
+    """
+    with storage.story_lock(story_id, 'audiobook'):
+        storage.get_audiobook_manifest_path(story_id).unlink(missing_ok=True)
+        storage.save_audiobook(story_id, audio_data)
+
+
+def refresh_audiobook(story_id: str) -> None:
+    """Update an existing audiobook after a chapter's audio was added or changed."""
+    with storage.story_lock(story_id, 'audiobook'):
+        manifest = load_manifest(story_id)
+        if not manifest:
+            return
+        chapter_numbers = [entry["chapter_number"] for entry in manifest["chapters"]]
+        while storage.has_chapter_audio(story_id, len(chapter_numbers) + 1):
+            chapter_numbers.append(len(chapter_numbers) + 1)
+        try:
+            build_audiobook(story_id, chapter_numbers)
+        except Exception as e:
+            logger.warning("Error refreshing audiobook for %s: %s", story_id, e)
@@ -1,164 +1,110 @@
 import os
-from openai import OpenAI
+import asyncio
+import logging
+from typing import Optional
 from dotenv import load_dotenv
 from io import BytesIO
 from pydub import AudioSegment
+import gateway
+import metrics
+import mp3
+import storage
+import tts_cache
+import tts_text
+import tracing
 
 load_dotenv()
 
-# Initialize OpenAI client
-openai = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-def chunk_text(text: str, max_length: int = 4000) -> list[str]:
-    """Split text into chunks that fit within OpenAI's TTS limit."""
-    # Split on sentences to avoid cutting words
-    sentences = text.replace('\n', ' ').split('. ')
-    chunks = []
-    current_chunk = []
-    current_length = 0
-    
-    for sentence in sentences:
-        # Add period back except for last sentence
-        sentence = sentence + '. ' if sentence != sentences[-1] else sentence
-        if current_length + len(sentence) > max_length:
-            if current_chunk:  # Save current chunk if it exists
-                chunks.append(''.join(current_chunk))
-            current_chunk = [sentence]
-            current_length = len(sentence)
-        else:
-            current_chunk.append(sentence)
-            current_length += len(sentence)
-    
-    if current_chunk:  # Add the last chunk
-        chunks.append(''.join(current_chunk))
-    
-    return chunks
-
-async def generate_audio(text: str) -> bytes:
-    """Generate audio from text using OpenAI's TTS."""
-    chunks = chunk_text(text)
-    print(f"Split text into {len(chunks)} chunks")
-    
-    # Generate audio for each chunk
-    audio_segments = []
-    for i, chunk in enumerate(chunks, 1):
-        print(f"Generating audio for chunk {i}/{len(chunks)} (length: {len(chunk)})")
-        response = openai.audio.speech.create(
-            model="tts-1",
-            voice="nova",
-            input=chunk
-        )
-        # Convert bytes to AudioSegment
-        audio_segment = AudioSegment.from_mp3(BytesIO(response.content))
-        audio_segments.append(audio_segment)
-    
-    # Combine audio segments
-    if len(audio_segments) == 1:
-        # Convert single segment back to bytes
-        buffer = BytesIO()
-        audio_segments[0].export(buffer, format='mp3')
-        return buffer.getvalue()
-    
-    # Concatenate all segments
-    print(f"Concatenating {len(audio_segments)} audio segments")
-    combined = audio_segments[0]
-    for segment in audio_segments[1:]:
-        combined = combined + segment
-    
+logger = logging.getLogger(__name__)
+
+# How many chunks of one chapter are sent to TTS at the same time
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
+
+TTS_MODEL = os.getenv("TTS_MODEL", "tts-1")
+TTS_VOICE = os.getenv("TTS_VOICE", "nova")
+TTS_FORMAT = "mp3"
+
+def chunk_text(text: str, max_length: int = tts_text.CHUNK_MAX_CHARS) -> list[str]:
+    """Split chapter markdown into speakable chunks that fit within OpenAI's TTS limit."""
+    return tts_text.chunk_text(text, max_length)
+
+async def synthesize_chunk(chunk: str, semaphore: asyncio.Semaphore) -> bytes:
+    """Synthesize one chunk; the gateway handles rate limits and retries."""
+    async with semaphore:
+        with tracing.span('tts_chunk', model=TTS_MODEL, voice=TTS_VOICE, text_length=len(chunk)) as span, \
+                metrics.TTS_CHUNK_SECONDS.time(model=TTS_MODEL):
+            response = await gateway.openai.call(lambda client: client.audio.speech.create(
+                model=TTS_MODEL,
+                voice=TTS_VOICE,
+                input=chunk,
+                response_format=TTS_FORMAT
+            ), tokens=len(chunk))
+            span.set(bytes=len(response.content))
+        metrics.TTS_CHARACTERS.inc(len(chunk), model=TTS_MODEL)
+        return response.content
+
+async def synthesize_cached(chunk: str, key: str, semaphore: asyncio.Semaphore) -> bytes:
+    """Synthesize a chunk that wasn't cached, caching it as soon as it's done."""
+    audio = await synthesize_chunk(chunk, semaphore)
+    await storage.run_io(tts_cache.put, key, audio)
+    return audio
+
+async def generate_audio(text: str, story_id: Optional[str] = None, chapter_number: Optional[int] = None) -> bytes:
+    """Generate audio from text using OpenAI's TTS.
+
+    Chunks already synthesized with the same voice, model and format (for
+    this chapter or anywhere else) come from the TTS cache, so regenerating
+    after a small edit only pays for the chunks that changed. Given a
+    chapter, the chunk hashes are recorded alongside its audio.
+    """
+    with metrics.IN_PROGRESS.track(kind='audio'), tracing.span(
+        'generate_audio', story_id=story_id, chapter_number=chapter_number, text_length=len(text)
+    ) as span:
+        chunks = chunk_text(text)
+        keys = [tts_cache.chunk_key(chunk, TTS_VOICE, TTS_MODEL, TTS_FORMAT) for chunk in chunks]
+        responses = list(await asyncio.gather(*(storage.run_io(tts_cache.get, key) for key in keys)))
+        missing = [i for i, audio in enumerate(responses) if audio is None]
+        span.set(chunks=len(chunks), cached_chunks=len(chunks) - len(missing))
+        logger.debug("Split text into %d chunks (%d cached)", len(chunks), len(chunks) - len(missing))
+        metrics.TTS_CHUNKS.inc(len(chunks) - len(missing), source='cache')
+        metrics.TTS_CHUNKS.inc(len(missing), source='api')
+
+        # Synthesize the rest concurrently; gather keeps them in order
+        semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+        synthesized = await asyncio.gather(*(synthesize_cached(chunks[i], keys[i], semaphore) for i in missing))
+        for i, audio in zip(missing, synthesized):
+            responses[i] = audio
+
+        if story_id is not None:
+            await storage.run_io(tts_cache.save_chunk_manifest, story_id, chapter_number, keys)
+        if missing:
+            await storage.run_io(tts_cache.evict)
+
+        audio = join_mp3(responses)
+        span.set(bytes=len(audio))
+        return audio
+
+def join_mp3(parts: list[bytes], gap_ms: int = 0) -> bytes:
+    """Join MP3 files, with gap_ms of silence between them.
+
+    Same-format files are joined frame by frame with no re-encoding; anything
+    else falls back to decoding and re-encoding through pydub.
+    """
+    try:
+        with metrics.AUDIO_PROCESS_SECONDS.time(operation='concatenate'):
+            return mp3.concatenate(parts, gap_ms=gap_ms)
+    except ValueError as e:
+        logger.info("Falling back to re-encoding MP3: %s", e)
+
+    combined = AudioSegment.empty()
+    with metrics.AUDIO_PROCESS_SECONDS.time(operation='decode'):
+        for part in parts:
+            if len(combined) > 0 and gap_ms:
+                combined += AudioSegment.silent(duration=gap_ms)
+            combined += AudioSegment.from_mp3(BytesIO(part))
+
     # Export combined audio to bytes
     buffer = BytesIO()
-    combined.export(buffer, format='mp3')
+    with metrics.AUDIO_PROCESS_SECONDS.time(operation='encode'):
+        combined.export(buffer, format='mp3')
     return buffer.getvalue()
-
-async def save_chapter_audio(db, story_id, chapter_number, audio_bytes):
-    """Save audio data to the chapter in the database."""
-    print(f"save_chapter_audio - chapter_number type: {type(chapter_number)}, value: {chapter_number}")
-    # First verify the chapter exists
-    chapter = await db.query('''
-        SELECT id
-        FROM chapter
-        WHERE story = type::thing('story', $story_id) 
-        AND chapter_number = type::int($chapter_number)
-        LIMIT 1;
-    ''', {
-        'story_id': story_id,
-        'chapter_number': chapter_number
-    })
-
-    if not chapter or not chapter[0]["result"]:
-        print(f"No chapter found to save audio: {story_id} #{chapter_number}")
-        raise ValueError(f"Chapter not found: {story_id} #{chapter_number}")
-
-    print(f"Saving audio data (length: {len(audio_bytes)} bytes)")
-
-    # Save the audio using a parameterized query
-    result = await db.query('''
-        LET $chapter = (
-            SELECT id 
-            FROM chapter 
-            WHERE story = type::thing('story', $story_id) 
-            AND chapter_number = type::int($chapter_number)
-            LIMIT 1
-        );
-
-        UPDATE $chapter[0]
-        SET 
-            audio_data = $audio_data,
-            audio_mime = $audio_mime,
-            updated_at = time::now()
-        RETURN AFTER;
-    ''', {
-        'story_id': story_id,
-        'chapter_number': chapter_number,
-        'audio_data': audio_bytes,
-        'audio_mime': 'audio/mp3'
-    })
-
-    if not result or not result[0]["result"]:
-        raise ValueError("Failed to save audio: no result from update query")
-
-    updated = result[0]["result"][0]
-    print(f"Audio saved. Updated record:", {
-        'id': updated.get('id'),
-        'has_audio': updated.get('audio_data') is not None,
-        'audio_length': len(updated.get('audio_data', b'')) if updated.get('audio_data') else 0,
-        'mime_type': updated.get('audio_mime')
-    })
-
-async def get_chapter_audio(db, story_id, chapter_number):
-    """Retrieve audio data for a chapter from the database."""
-    chapter = await db.query('''
-        SELECT audio_data, audio_mime
-        FROM chapter
-        WHERE story = type::thing('story', $story_id) AND chapter_number = $chapter_number
-        LIMIT 1;
-    ''', {
-        'story_id': story_id,
-        'chapter_number': chapter_number
-    })
-
-    if not chapter or not chapter[0]["result"] or not chapter[0]["result"][0]["audio_data"]:
-        print(f"No audio found for story {story_id} chapter {chapter_number}", chapter[0]["result"])
-        return None, None
-
-    result = chapter[0]["result"][0]
-    return result["audio_data"], result["audio_mime"]
-
-async def get_chapter_text(db, story_id, chapter_number):
-    """Get the text content of a chapter."""
-    print(f"get_chapter_text - chapter_number type: {type(chapter_number)}, value: {chapter_number}")
-    chapter = await db.query('''
-        SELECT content
-        FROM chapter
-        WHERE story = type::thing('story', $story_id) AND chapter_number = type::int($chapter_number)
-        LIMIT 1;
-    ''', {
-        'story_id': story_id,
-        'chapter_number': chapter_number
-    })
-
-    if not chapter or not chapter[0]["result"]:
-        return None
-
-    return chapter[0]["result"][0]["content"]
-  
\ No newline at end of file
@@ -0,0 +1,109 @@
+"""Micro-benchmark for the TTS chunker.
+
+Generates chapter-like markdown (headings, bold titles, dialogue, ellipses,
+abbreviations, lists and the odd run-on sentence) and compares speed and
+chunk counts with the old split-on-'. ' chunker. The chunker's guarantees
+are checked by tests/test_tts_text.py, which uses these chapters too.
+
+    python bench_chunking.py [--chapters 200] [--words 3000] [--rounds 5] [--seed 1]
+"""
+import argparse
+import random
+import statistics
+import time
+from typing import Callable, List
+import tts_text
+
+WORDS = (
+    "the storm rolled over hills while she waited by old door and listened for "
+    "footsteps in dark hall where lantern light flickered against stone walls"
+).split()
+NAMES = ["Mara", "Dr. Ellis", "Mr. Hale", "Captain Reyes", "Jo"]
+
+
+def legacy_chunk_text(text: str, max_length: int = 4000) -> List[str]:
+    """The chunker this replaced, for comparison."""
+    sentences = text.replace('\n', ' ').split('. ')
+    chunks, current_chunk, current_length = [], [], 0
+    for sentence in sentences:
+        sentence = sentence + '. ' if sentence != sentences[-1] else sentence
+        if current_length + len(sentence) > max_length:
+            if current_chunk:
+                chunks.append(''.join(current_chunk))
+            current_chunk, current_length = [sentence], len(sentence)
+        else:
+            current_chunk.append(sentence)
+            current_length += len(sentence)
+    if current_chunk:
+        chunks.append(''.join(current_chunk))
+    return chunks
+
+
+def sentence(rng: random.Random, min_words: int = 4, max_words: int = 25) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    if rng.random() < 0.2:
+        words.insert(rng.randrange(len(words)), rng.choice(NAMES))
+    if rng.random() < 0.15:
+        i = rng.randrange(len(words))
+        mark = rng.choice(["*", "_", "**"])
+        words[i] = f"{mark}{words[i]}{mark}"
+    text = ' '.join(words)
+    text = text[0].upper() + text[1:]
+    ending = rng.choice(['.', '.', '.', '?', '!', '...', '…'])
+    if rng.random() < 0.25:
+        return f'"{text}{ending}" {rng.choice(NAMES)} said.'
+    return text + ending
+
+
+def chapter(rng: random.Random, words: int) -> str:
+    parts = [f"# Chapter {rng.randint(1, 30)}", f"**{' '.join(rng.sample(WORDS, 3)).title()}**"]
+    count = 0
+    while count < words:
+        roll = rng.random()
+        if roll < 0.03:
+            # A run-on sentence longer than a whole chunk
+            block = ', '.join(sentence(rng, 20, 40).rstrip('.!?…') for _ in range(40)) + '.'
+        elif roll < 0.08:
+            block = '\n'.join(f"- {sentence(rng, 3, 8)}" for _ in range(rng.randint(2, 5)))
+        elif roll < 0.1:
+            block = '---'
+        else:
+            block = ' '.join(sentence(rng) for _ in range(rng.randint(2, 8)))
+            if rng.random() < 0.1:
+                block = f"> {block}"
+        parts.append(block)
+        count += len(block.split())
+    return '\n\n'.join(parts)
+
+
+def bench(name: str, func: Callable[[str], List[str]], texts: List[str], rounds: int) -> List[List[str]]:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        results = [func(text) for text in texts]
+        timings.append(time.perf_counter() - start)
+    per_chapter_us = statistics.median(timings) / len(texts) * 1e6
+    chunks = sum(len(result) for result in results)
+    oversized = sum(len(chunk) > tts_text.CHUNK_MAX_CHARS for result in results for chunk in result)
+    print(f"{name:<10} {per_chapter_us:>10.0f} us/chapter {chunks:>8} chunks {oversized:>6} over limit")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chapters", type=int, default=200)
+    parser.add_argument("--words", type=int, default=3000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = [chapter(rng, args.words) for _ in range(args.chapters)]
+    print(f"{args.chapters} chapters, ~{args.words} words each\n")
+
+    bench("legacy", legacy_chunk_text, texts, args.rounds)
+    bench("chunker", tts_text.chunk_text, texts, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
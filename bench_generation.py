@@ -0,0 +1,305 @@
+"""End-to-end story generation benchmark against local stand-in providers.
+
+Starts a fake Anthropic Messages API (streaming and not) and a fake OpenAI
+speech API that returns a real encoded clip (tests/fixtures/speech.mp3,
+64 kbps mono at 24 kHz like tts-1) repeated to length, each with
+configurable latency and payload size, then writes whole stories the way a generate-all job does:
+create the story, and for each chapter write it, record it and save the
+audio, then assemble the audiobook. Nothing is sent to the real providers.
+
+Per-stage latency percentiles, stories per minute and peak RSS are printed
+as JSON on stdout (application logs go to stderr).
+
+    python bench_generation.py --stories 4 --chapters 3 --words 800
+    python bench_generation.py --db surreal   # uses SURREAL_* from the environment
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import importlib
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List
+import mp3
+
+WORDS = (
+    "the storm rolled over hills while she waited by old door and listened for "
+    "footsteps in dark hall where lantern light flickered against stone walls"
+).split()
+
+# What the fake TTS serves: about a second of encoded speech-like audio
+SPEECH_CLIP = Path(__file__).parent / 'tests' / 'fixtures' / 'speech.mp3'
+# Roughly how fast the voice reads
+CHARS_PER_SECOND = 15
+
+
+@functools.lru_cache(maxsize=None)
+def speech_frames() -> List[bytes]:
+    data = SPEECH_CLIP.read_bytes()
+    return [data[offset:offset + header.length] for offset, header in mp3.iter_frames(data)]
+
+
+def speech_audio(duration_ms: int) -> bytes:
+    """The clip, repeated and cut at a frame boundary, to last about duration_ms."""
+    frames = speech_frames()
+    header = mp3.parse_header(frames[0], 0)
+    count = max(1, round(duration_ms * header.sample_rate / 1000 / header.samples))
+    return b''.join(itertools.islice(itertools.cycle(frames), count))
+
+
+def fake_prose(words: int, rng: random.Random) -> str:
+    """Chapter-like markdown that differs every call, so the TTS cache never hits."""
+    sentences = []
+    count = 0
+    while count < words:
+        length = rng.randint(6, 20)
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(length))
+        sentences.append(sentence[0].upper() + sentence[1:] + rng.choice('..?!'))
+        count += length
+    paragraphs = [' '.join(sentences[i:i + 5]) for i in range(0, len(sentences), 5)]
+    return f"**{uuid.uuid4().hex[:8].title()}**\n\n" + '\n\n'.join(paragraphs)
+
+
+class FakeProviders(BaseHTTPRequestHandler):
+    """Answers /v1/messages like Anthropic and /v1/audio/speech like OpenAI."""
+
+    options: argparse.Namespace
+    rng = random.Random(0)
+    counter = itertools.count(1)
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get('content-length', 0))) or b'{}')
+        if self.path.endswith('/messages'):
+            self.messages(body)
+        elif self.path.endswith('/audio/speech'):
+            self.speech(body)
+        else:
+            self.send_error(404)
+
+    def messages(self, body: Dict[str, Any]) -> None:
+        prompt_chars = len(json.dumps(body.get('system', ''))) + len(json.dumps(body.get('messages', [])))
+        usage = {"input_tokens": prompt_chars // 4, "output_tokens": 0,
+                 "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+        message = {"id": f"msg_{next(self.counter)}", "type": "message", "role": "assistant",
+                   "model": body.get("model", "fake"), "content": [], "stop_reason": None,
+                   "stop_sequence": None, "usage": usage}
+        time.sleep(self.options.llm_ttft)
+
+        if not body.get('stream'):
+            text = ' '.join(self.rng.choice(WORDS) for _ in range(min(40, body.get('max_tokens', 40))))
+            usage["output_tokens"] = len(text) // 4
+            message.update(content=[{"type": "text", "text": text}], stop_reason="end_turn")
+            payload = json.dumps(message).encode()
+            self.send_response(200)
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        text = fake_prose(body.get('max_tokens', 2000) // 2, self.rng)
+        self.send_response(200)
+        self.send_header('content-type', 'text/event-stream')
+        self.end_headers()
+
+        def event(kind: str, data: Dict[str, Any]) -> None:
+            self.wfile.write(f"event: {kind}\ndata: {json.dumps(dict(type=kind, **data))}\n\n".encode())
+            self.wfile.flush()
+
+        event("message_start", {"message": message})
+        event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        pieces = re.findall(r'\S+\s*', text)
+        for i in range(0, len(pieces), 10):
+            delta = ''.join(pieces[i:i + 10])
+            event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": delta}})
+            time.sleep(len(delta) / 4 / self.options.llm_tokens_per_second)
+        event("content_block_stop", {"index": 0})
+        event("message_delta", {"delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                "usage": {"output_tokens": len(text) // 4}})
+        event("message_stop", {})
+
+    def speech(self, body: Dict[str, Any]) -> None:
+        chars = len(body.get('input', ''))
+        time.sleep(self.options.tts_latency + chars / 1000 * self.options.tts_seconds_per_kchar)
+        audio = speech_audio(max(1, chars // CHARS_PER_SECOND) * 1000)
+        self.send_response(200)
+        self.send_header('content-type', 'audio/mpeg')
+        self.send_header('content-length', str(len(audio)))
+        self.end_headers()
+        self.wfile.write(audio)
+
+
+class StubDB:
+    """Just enough of the database for story and chapter generation, in memory."""
+
+    def __init__(self) -> None:
+        self.stories: Dict[str, Dict[str, Any]] = {}
+        self.chapters: Dict[str, List[Dict[str, Any]]] = {}
+
+    async def query(self, sql: str, params: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        params = params or {}
+        await asyncio.sleep(0)
+        sql = ' '.join(sql.split())
+        if sql.startswith('CREATE story'):
+            story_id = uuid.uuid4().hex[:20]
+            self.stories[story_id] = {
+                'prompt': params['prompt'], 'title': params['prompt'],
+                'num_chapters': params['total_chapters'], 'words_per_chapter': params['words_per_chapter'],
+                'context_tokens': params['context_tokens'],
+            }
+            self.chapters[story_id] = []
+            return [{"status": "OK", "result": [{"id": f"story:{story_id}"}]}]
+        if sql.startswith('SELECT VALUE chapter_number'):
+            numbers = [c['chapter_number'] for c in self.chapters[params['story_id']]
+                       if c['chapter_number'] < int(params['before'])]
+            return [{"status": "OK", "result": numbers}]
+        if sql.startswith('SELECT') and "FROM type::thing('story'" in sql:
+            return [{"status": "OK", "result": [self.stories[params['story_id']]]}]
+        if sql.startswith('CREATE chapter'):
+            record = {k: v for k, v in params.items() if k != 'story_id'}
+            self.chapters[params['story_id']].append(record)
+            return [{"status": "OK", "result": [record]}]
+        if sql.startswith('UPDATE chapter SET audio_size'):
+            for record in self.chapters[params['story_id']]:
+                if record['chapter_number'] == int(params['chapter_number']):
+                    record.update((key, value) for key, value in params.items() if key.startswith('audio_'))
+            return [{"status": "OK", "result": []}]
+        if sql.startswith("UPDATE type::thing('story'"):
+            self.stories[params['story_id']]['title'] = params['title']
+            return [{"status": "OK", "result": [self.stories[params['story_id']]]}]
+        raise NotImplementedError(f"StubDB doesn't handle: {sql[:80]}")
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean": round(statistics.fmean(ordered), 4),
+        "p50": round(at(0.5), 4),
+        "p90": round(at(0.9), 4),
+        "p99": round(at(0.99), 4),
+        "max": round(ordered[-1], 4),
+    }
+
+
+async def run(options: argparse.Namespace, database) -> Dict[str, Any]:
+    story = importlib.import_module('story')
+    chapter = importlib.import_module('chapter')
+    audiogen = importlib.import_module('audiogen')
+    audiobook = importlib.import_module('audiobook')
+    storage = importlib.import_module('storage')
+
+    timings: Dict[str, List[float]] = {stage: [] for stage in ('create_story', 'chapter', 'audio', 'audiobook', 'story')}
+    limit = asyncio.Semaphore(options.concurrency)
+
+    @contextlib.asynccontextmanager
+    async def timed(stage: str):
+        start = time.perf_counter()
+        yield
+        timings[stage].append(time.perf_counter() - start)
+
+    async def one_story(n: int) -> None:
+        async with limit, timed('story'):
+            async with timed('create_story'):
+                story_id, error = await story.create_story(
+                    database, f"Benchmark story {n}", options.chapters, options.words
+                )
+            if error:
+                raise RuntimeError(f"create_story failed: {error}")
+            for chapter_number in range(1, options.chapters + 1):
+                async with timed('chapter'):
+                    content = await chapter.generate_new_chapter(database, story_id, chapter_number)
+                async with timed('audio'):
+                    audio = await audiogen.generate_audio(content, story_id, chapter_number)
+                    await chapter.save_chapter_audio(database, story_id, chapter_number, audio)
+            async with timed('audiobook'):
+                await storage.run_io(audiobook.build_audiobook, story_id, list(range(1, options.chapters + 1)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_story(n) for n in range(options.stories)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "config": vars(options),
+        "elapsed_seconds": round(elapsed, 3),
+        "stories_per_minute": round(options.stories / elapsed * 60, 3),
+        "stages": {stage: percentiles(samples) for stage, samples in timings.items()},
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stories", type=int, default=4)
+    parser.add_argument("--chapters", type=int, default=3)
+    parser.add_argument("--words", type=int, default=800, help="words per chapter")
+    parser.add_argument("--concurrency", type=int, default=2, help="stories generated at once")
+    parser.add_argument("--llm-ttft", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=400)
+    parser.add_argument("--tts-latency", type=float, default=0.3, help="seconds per TTS request")
+    parser.add_argument("--tts-seconds-per-kchar", type=float, default=0.2)
+    parser.add_argument("--db", choices=["stub", "surreal"], default="stub")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    options = parser.parse_args()
+
+    FakeProviders.options = options
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeProviders)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    # Must be set before the app modules create their clients
+    data_dir = tempfile.mkdtemp(prefix="storymode-bench-")
+    os.environ.update({
+        "ANTHROPIC_BASE_URL": base_url,
+        "ANTHROPIC_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "OPENAI_API_KEY": "benchmark",
+        "USER_DATA_DIR": data_dir,
+    })
+    for limit in ("ANTHROPIC_RPM", "ANTHROPIC_TPM", "OPENAI_TTS_RPM"):
+        os.environ.setdefault(limit, "0")
+
+    with contextlib.redirect_stdout(sys.stderr):
+        if options.db == "surreal":
+            database = importlib.import_module('db').db
+        else:
+            database = StubDB()
+        try:
+            results = asyncio.run(run(options, database))
+        finally:
+            server.shutdown()
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+
+
+if __name__ == "__main__":
+    main()
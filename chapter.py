@@ -1,20 +1,29 @@
 import os
+import logging
 from datetime import datetime
-from anthropic import Anthropic
 from dotenv import load_dotenv
+import gateway
+import metrics
+import read_cache
 import storage
+import tracing
 
 load_dotenv()
 
-# Initialize Anthropic client
-anthropic = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+logger = logging.getLogger(__name__)
+
+# Default token budget for previous-chapter context; stories can override it
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "claude-3-haiku-20240307")
+# Must be a model that supports prompt caching
+CHAPTER_MODEL = os.getenv("CHAPTER_MODEL", "claude-3-5-sonnet-20241022")
 
 async def get_chapter(db, story_id, chapter_number):
     """Get a single chapter's content and audio status."""
     # Check if chapter exists in database
     chapter = await db.query('''
         SELECT 
-            audio_mimetype ?? false as has_audio
+            audio_size != NONE AS has_audio
         FROM chapter
         WHERE story = type::thing('story', $story_id) 
         AND chapter_number = type::int($chapter_number)
@@ -25,20 +34,18 @@ async def get_chapter(db, story_id, chapter_number):
     })
 
     if not chapter or not chapter[0]["result"] or not chapter[0]["result"][0]:
-        print(f"No chapter found for {story_id} #{chapter_number}")
+        logger.warning("No chapter found for %s #%s", story_id, chapter_number)
         raise ValueError(f"Chapter not found: {story_id} #{chapter_number}")
 
     # Get content from filesystem
-    content = storage.get_chapter_text(story_id, chapter_number)
+    content = await storage.get_chapter_text_async(story_id, chapter_number)
     if not content:
         raise ValueError(f"Chapter content not found: {story_id} #{chapter_number}")
 
     result = chapter[0]["result"][0]
     result["content"] = content
-    print(f"Chapter {chapter_number} data:", {
-        'has_audio': result.get('has_audio'),
-        'content_length': len(content),
-    })
+    logger.debug("Loaded chapter %s", chapter_number,
+                 extra={'has_audio': result.get('has_audio'), 'content_length': len(content)})
     # Ensure has_audio is a proper boolean
     result["has_audio"] = bool(result.get("has_audio", False))
     return result
@@ -74,7 +81,7 @@ async def get_chapters_list(db, story_id):
 async def get_story_details(db, story_id):
     """Get story details needed for chapter generation."""
     story = await db.query('''
-        SELECT prompt, num_chapters, words_per_chapter
+        SELECT prompt, num_chapters, words_per_chapter, context_tokens
         FROM type::thing('story', $story_id);
     ''', {
         'story_id': story_id
@@ -85,64 +92,180 @@ async def get_story_details(db, story_id):
 
     return story[0]["result"][0]
 
-async def get_previous_chapter(db, story_id, chapter_number):
-    """Get the content of the previous chapter."""
-    if chapter_number <= 1:
-        return None
-        
-    try:
-        prev_chapter = await get_chapter(db, story_id, chapter_number - 1)
-        return prev_chapter["content"] if prev_chapter else None
-    except ValueError:
-        return None
+async def get_chapter_numbers(db, story_id, before):
+    """Get the numbers of a story's saved chapters before the given one, in one query."""
+    chapters = await db.query('''
+        SELECT VALUE chapter_number
+        FROM chapter
+        WHERE story = type::thing('story', $story_id)
+        AND chapter_number < type::int($before)
+        ORDER BY chapter_number;
+    ''', {
+        'story_id': story_id,
+        'before': before
+    })
 
-async def get_all_previous_chapters(db, story_id, current_chapter):
-    """Get the content of all previous chapters."""
-    chapters = []
-    for i in range(1, current_chapter):
-        try:
-            chapter = await get_chapter(db, story_id, i)
-            chapters.append(chapter["content"])
-        except ValueError:
-            print(f"Warning: Could not find chapter {i}")
-            continue
-    return chapters
-
-async def generate_chapter_content(story_data, chapter_number, prev_chapters):
-    """Generate chapter content using Claude."""
-    chapter_prompt = f"Chapter {chapter_number} of {story_data['num_chapters']}"
-    
-    if chapter_number == 1:
-        chapter_prompt += f"\n\nStory prompt: {story_data['prompt']}"
-    elif prev_chapters:
-        chapter_prompt += "\n\nPrevious chapters:\n"
-        for i, content in enumerate(prev_chapters, 1):
-            chapter_prompt += f"\nChapter {i}:\n{content}\n"
-
-    message = anthropic.messages.create(
-        model="claude-3-sonnet-20240229",
-        max_tokens=story_data['words_per_chapter'] * 2,  # Give some buffer
-        temperature=0.9,
-        system=(
-            "You are a creative storyteller. Write engaging, vivid stories based on user prompts. "
-            "Write only the story content, no other text. "
-            "Write in markdown format. Start the chapter with the chapter title in bold. "
-            f"Each chapter should be approximately {story_data['words_per_chapter']} words."
-        ),
+    if not chapters or chapters[0]["status"] == "ERR":
+        raise ValueError(f"Failed to list chapters: {story_id}")
+    return sorted(chapters[0]["result"] or [])
+
+def estimate_tokens(text):
+    """Rough token count: about four characters per token for English prose."""
+    return len(text) // 4 + 1
+
+async def summarize_chapter(content):
+    """Write a compact summary of a chapter for use as later context."""
+    message = await gateway.anthropic.call(lambda client: client.messages.create(
+        model=SUMMARY_MODEL,
+        max_tokens=400,
+        temperature=0.3,
+        system="You summarize story chapters for a writer who is continuing the story.",
         messages=[
             {
                 "role": "user",
-                "content": f"Write {chapter_prompt}"
+                "content": (
+                    "Summarize this chapter in under 150 words. Keep character names, relationships, "
+                    f"open plot threads and where the chapter leaves off.\n\n{content}"
+                )
             }
         ]
-    )
-    
-    return message.content[0].text
+    ), tokens=estimate_tokens(content) + 400)
+
+    return message.content[0].text.strip()
+
+async def get_chapter_summary(story_id, chapter_number):
+    """Get a chapter's summary, writing one first if it's missing."""
+    summary = await storage.get_chapter_summary_async(story_id, chapter_number)
+    if summary:
+        return summary
+
+    content = await storage.get_chapter_text_async(story_id, chapter_number)
+    if not content:
+        return None
+    summary = await summarize_chapter(content)
+    await storage.save_chapter_summary_async(story_id, chapter_number, summary)
+    return summary
+
+async def build_chapter_context(db, story_data, story_id, chapter_number):
+    """Get previous-chapter context for a new chapter, within the story's token budget."""
+    if chapter_number <= 1:
+        return []
+
+    budget = story_data.get('context_tokens') or CONTEXT_TOKEN_BUDGET
+    context = []
+
+    with tracing.span('fetch_previous_chapters', story_id=story_id, chapter_number=chapter_number) as span:
+        existing = set(await get_chapter_numbers(db, story_id, chapter_number))
+        last = None
+        if chapter_number - 1 in existing:
+            last = await storage.get_chapter_text_async(story_id, chapter_number - 1)
+        if last:
+            if estimate_tokens(last) > budget:
+                last = last[-budget * 4:]
+            context.append({'chapter_number': chapter_number - 1, 'text': last, 'is_summary': False})
+            budget -= estimate_tokens(last)
+
+        # Summaries only cost an API call the first time (e.g. for older stories),
+        # so stop fetching them once the budget is spent
+        for n in range(chapter_number - 2, 0, -1):
+            if n not in existing:
+                continue
+            if budget <= 0:
+                logger.info("Context budget reached; leaving out chapters 1-%s", n)
+                break
+            try:
+                summary = await get_chapter_summary(story_id, n)
+            except Exception as e:
+                logger.warning("Leaving out chapter %s of %s; could not summarize it: %s", n, story_id, e)
+                continue
+            if not summary:
+                logger.warning("Could not find chapter %s of %s", n, story_id)
+                continue
+            if estimate_tokens(summary) > budget:
+                logger.info("Context budget reached; leaving out chapters 1-%s", n)
+                break
+            context.append({'chapter_number': n, 'text': summary, 'is_summary': True})
+            budget -= estimate_tokens(summary)
+
+        span.set(chapters=len(context), text_length=sum(len(prev['text']) for prev in context))
+
+    context.reverse()
+    return context
+
+CACHE_BREAKPOINT = {"type": "ephemeral"}
+
+def build_chapter_request(story_data, chapter_number, prev_chapters):
+    """Build the system prompt and message blocks for a chapter, stable parts first."""
+    system = [{
+        "type": "text",
+        "text": (
+            "You are a creative storyteller. Write engaging, vivid stories based on user prompts. "
+            "Write only the story content, no other text. "
+            "Write in markdown format. Start the chapter with the chapter title in bold. "
+            f"Each chapter should be approximately {story_data['words_per_chapter']} words."
+        )
+    }]
+
+    blocks = [{"type": "text", "text": f"Story prompt: {story_data['prompt']}"}]
+    for prev in prev_chapters or []:
+        label = " (summary)" if prev['is_summary'] else ""
+        blocks.append({"type": "text", "text": f"Chapter {prev['chapter_number']}{label}:\n{prev['text']}"})
+
+    # The next chapter shares everything up to the last summary; the full previous
+    # chapter is never resent. Prefixes under 1024 tokens aren't cached anyway
+    summaries = [i for i, prev in enumerate(prev_chapters or []) if prev['is_summary']]
+    if summaries:
+        blocks[summaries[-1] + 1]["cache_control"] = CACHE_BREAKPOINT
+
+    blocks.append({"type": "text", "text": f"Write Chapter {chapter_number} of {story_data['num_chapters']}"})
+    return system, [{"role": "user", "content": blocks}]
+
+async def stream_chapter_content(story_data, chapter_number, prev_chapters, usage=None):
+    """Stream chapter content from Claude, yielding text as it arrives.
+
+    If a dict is passed as usage, it is filled with the response's token
+    counts (including prompt cache reads and writes) once the stream ends.
+    """
+    system, messages = build_chapter_request(story_data, chapter_number, prev_chapters)
+
+    max_tokens = story_data['words_per_chapter'] * 2  # Give some buffer
+    estimate = sum(estimate_tokens(block["text"]) for block in system + messages[0]["content"]) + max_tokens
+
+    with tracing.span('generate_chapter_content', chapter_number=chapter_number, model=CHAPTER_MODEL) as span:
+        length = 0
+        async with gateway.anthropic.stream(lambda client: client.messages.stream(
+            model=CHAPTER_MODEL,
+            max_tokens=max_tokens,
+            temperature=0.9,
+            system=system,
+            messages=messages
+        ), tokens=estimate) as stream:
+            async for text in stream.text_stream:
+                length += len(text)
+                yield text
+            message = await stream.get_final_message()
+        gateway.anthropic.settle(estimate, message.usage)
+
+        counts = {
+            'input_tokens': message.usage.input_tokens,
+            'output_tokens': message.usage.output_tokens,
+            'cache_creation_input_tokens': message.usage.cache_creation_input_tokens or 0,
+            'cache_read_input_tokens': message.usage.cache_read_input_tokens or 0,
+        }
+        span.set(text_length=length, **counts)
+    logger.info("Chapter %s tokens", chapter_number, extra=counts)
+    if usage is not None:
+        usage.update(counts)
+
+async def generate_chapter_content(story_data, chapter_number, prev_chapters, usage=None):
+    """Generate chapter content using Claude."""
+    parts = [text async for text in stream_chapter_content(story_data, chapter_number, prev_chapters, usage)]
+    return ''.join(parts)
 
 async def generate_title(prompt, first_chapter):
     """Generate a title for the story based on the first chapter."""
-    title_message = anthropic.messages.create(
-        model="claude-3-sonnet-20240229",
+    title_message = await gateway.anthropic.call(lambda client: client.messages.create(
+        model=CHAPTER_MODEL,
         max_tokens=50,
         temperature=0.7,
         system="You are a creative writer who creates engaging, concise titles.",
@@ -152,39 +275,80 @@ async def generate_title(prompt, first_chapter):
                 "content": f"Create a short, engaging title (max 5 words) for this story:\n\nPrompt: {prompt}\n\nFirst chapter:\n{first_chapter}"
             }
         ]
-    )
+    ), tokens=estimate_tokens(prompt + first_chapter) + 50)
     
     return title_message.content[0].text.strip('" ')
 
-async def save_chapter(db, story_id, chapter_number, content):
-    """Save a new chapter to the database and filesystem."""
+async def save_chapter(db, story_id, chapter_number, content, usage=None):
+    """Save a new chapter to the database and filesystem.
+
+    usage holds the generation's token counts, kept to track prompt caching.
+    """
+    usage = usage or {}
     now = datetime.utcnow().isoformat()
     
     # Save content to filesystem
-    storage.save_chapter_text(story_id, chapter_number, content)
+    await storage.save_chapter_text_async(story_id, chapter_number, content)
     
-    # Create chapter record in database (with empty content to satisfy schema)
+    # Create chapter record in database
     result = await db.query('''
         CREATE chapter SET
             story = type::thing('story', $story_id),
             chapter_number = type::int($chapter_number),
-            content = $content,
+            input_tokens = $input_tokens,
+            output_tokens = $output_tokens,
+            cache_creation_input_tokens = $cache_creation_input_tokens,
+            cache_read_input_tokens = $cache_read_input_tokens,
             created_at = $now,
             updated_at = $now
         RETURN AFTER;
     ''', {
         'story_id': story_id,
         'chapter_number': chapter_number,
-        'content': '',  # Empty string to satisfy schema
+        'input_tokens': usage.get('input_tokens', 0),
+        'output_tokens': usage.get('output_tokens', 0),
+        'cache_creation_input_tokens': usage.get('cache_creation_input_tokens', 0),
+        'cache_read_input_tokens': usage.get('cache_read_input_tokens', 0),
         'now': now
     })
+    read_cache.invalidate_story(story_id)
 
     if not result or result[0]["status"] == "ERR":
         raise ValueError("Failed to save chapter: " + str(result[0].get("result", "Unknown error")))
-    print("Saved chapter to database", result[0])
+    logger.debug("Saved chapter %s of %s to database", chapter_number, story_id)
 
     return result[0]["result"][0]
 
+async def save_chapter_audio(db, story_id, chapter_number, audio_bytes):
+    """Save a chapter's audio to disk and record its length and format on the chapter."""
+    audio = await storage.save_chapter_audio_async(story_id, chapter_number, audio_bytes)
+    await record_chapter_audio(db, story_id, chapter_number, audio)
+
+async def record_chapter_audio(db, story_id, chapter_number, audio):
+    """Record the saved audio's size, length, format and hash on the chapter row."""
+    await db.query('''
+        UPDATE chapter SET
+            audio_size = $audio_size,
+            audio_duration_ms = $audio_duration_ms,
+            audio_bitrate = $audio_bitrate,
+            audio_sample_rate = $audio_sample_rate,
+            audio_sha256 = $audio_sha256,
+            updated_at = $now
+        WHERE story = type::thing('story', $story_id)
+        AND chapter_number = type::int($chapter_number);
+    ''', {
+        'story_id': story_id,
+        'chapter_number': chapter_number,
+        'audio_size': audio.size,
+        'audio_duration_ms': audio.duration_ms,
+        'audio_bitrate': audio.bitrate,
+        'audio_sample_rate': audio.sample_rate,
+        'audio_sha256': audio.sha256,
+        'now': datetime.utcnow().isoformat()
+    })
+    # Saving the file invalidated too, but a page may have been read in between
+    read_cache.invalidate_story(story_id)
+
 async def update_story_title(db, story_id, title):
     """Update the story's title."""
     result = await db.query('''
@@ -195,31 +359,50 @@ async def update_story_title(db, story_id, title):
         'story_id': story_id,
         'title': title
     })
+    read_cache.invalidate_story(story_id)
 
     if not result or not result[0]["result"]:
         raise ValueError("Failed to update title")
 
     return result[0]["result"][0]
 
+async def stream_new_chapter(db, story_id, chapter_number):
+    """Generate a new chapter, yielding text as it streams in, then save it."""
+    with metrics.IN_PROGRESS.track(kind='chapter'), \
+            tracing.span('generate_new_chapter', story_id=story_id, chapter_number=chapter_number) as span:
+        # Get story details
+        story_data = await get_story_details(db, story_id)
+
+        # Get previous chapters (last in full, earlier ones summarized) if needed
+        prev_chapters = None
+        if chapter_number > 1:
+            prev_chapters = await build_chapter_context(db, story_data, story_id, chapter_number)
+
+        # Stream chapter content
+        parts = []
+        usage = {}
+        async for text in stream_chapter_content(story_data, chapter_number, prev_chapters, usage):
+            parts.append(text)
+            yield text
+        content = ''.join(parts)
+        span.set(text_length=len(content))
+
+        # For first chapter, generate and update title
+        if chapter_number == 1:
+            title = await generate_title(story_data["prompt"], content)
+            if title:
+                await update_story_title(db, story_id, title)
+
+        # Save the chapter
+        await save_chapter(db, story_id, chapter_number, content, usage)
+
+        # Summarize it now so later chapters don't need its full text
+        try:
+            await storage.save_chapter_summary_async(story_id, chapter_number, await summarize_chapter(content))
+        except Exception as e:
+            logger.warning("Error summarizing chapter %s: %s", chapter_number, e)
+
 async def generate_new_chapter(db, story_id, chapter_number):
     """Main function to generate and save a new chapter."""
-    # Get story details
-    story_data = await get_story_details(db, story_id)
-
-    # Get all previous chapters if needed
-    prev_chapters = None
-    if chapter_number > 1:
-        prev_chapters = await get_all_previous_chapters(db, story_id, chapter_number)
-
-    # Generate chapter content
-    content = await generate_chapter_content(story_data, chapter_number, prev_chapters)
-
-    # For first chapter, generate and update title
-    if chapter_number == 1:
-        title = await generate_title(story_data["prompt"], content)
-        if title:
-            await update_story_title(db, story_id, title)
-
-    # Save the chapter
-    await save_chapter(db, story_id, chapter_number, content)
-    return content 
\ No newline at end of file
+    parts = [text async for text in stream_new_chapter(db, story_id, chapter_number)]
+    return ''.join(parts)
@@ -1,78 +1,170 @@
-from typing import Self
+from typing import Self, Optional
+from contextlib import asynccontextmanager
+from weakref import WeakKeyDictionary
 from surrealdb import AsyncSurrealDB
+import asyncio
+import logging
+import time
 import os
 from dotenv import load_dotenv
+import metrics
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
-class Database:
-    def __init__(self: Self) -> None:
-        self.db = AsyncSurrealDB(url=os.getenv('SURREAL_URL'))
+# Maximum number of live sessions kept per event loop
+POOL_SIZE = int(os.getenv('SURREAL_POOL_SIZE', '8'))
+# Idle sessions older than this (seconds) are pinged before being handed out
+HEALTH_CHECK_INTERVAL = float(os.getenv('SURREAL_HEALTH_CHECK_INTERVAL', '30'))
 
 
-    async def close(self: Self) -> None:
+class Session:
+    """A single authenticated SurrealDB connection checked out of the pool."""
+
+    def __init__(self: Self, conn: AsyncSurrealDB) -> None:
+        self.conn = conn
+        self.loop = asyncio.get_running_loop()
+        self.last_used = time.monotonic()
+        self.broken = False
+
+
+    async def query(self: Self, *args, **kwargs):
+        start = time.perf_counter()
         try:
-            await self.db.close()
-        except:
-            print("Failed to close database connection")
-            pass
+            result = await self.conn.query(*args, **kwargs)
+        except Exception:
+            # Any transport failure poisons the socket; the pool will replace it
+            self.broken = True
+            metrics.DB_ERRORS.inc()
+            raise
+        finally:
+            metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - start)
+        self.last_used = time.monotonic()
+        return result
+
+
+    def reusable(self: Self) -> bool:
+        """Whether this session can go back into the pool."""
+        return not self.broken and not self.loop.is_closed()
+
+
+    async def ping(self: Self) -> bool:
+        try:
+            await self.query('RETURN true;')
+            return True
+        except Exception:
+            return False
+
+
+    def discard(self: Self) -> None:
+        """Close the underlying socket on whichever loop owns it."""
+        if self.loop.is_closed():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.conn.close(), self.loop)
+        except Exception:
+            logger.warning("Failed to close database session", exc_info=True)
+
+
+class Database:
+    """A bounded pool of SurrealDB sessions.
+
+    Sessions sign in and select the namespace once, then stay open and are
+    handed out per request with ``acquire``/``release``. Sockets are tied to
+    the event loop that opened them, so idle sessions from another loop are
+    dropped and replaced rather than reused.
+    """
+
+    def __init__(self: Self, size: int = POOL_SIZE) -> None:
+        self.url = os.getenv('SURREAL_URL')
+        self.size = size
+        self._idle: list[Session] = []
+        self._limits: WeakKeyDictionary = WeakKeyDictionary()
+        self._token: Optional[str] = None
+
+
+    def _limit(self: Self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        limit = self._limits.get(loop)
+        if limit is None:
+            limit = self._limits[loop] = asyncio.Semaphore(self.size)
+        return limit
+
+
+    async def _connect(self: Self) -> Session:
+        conn = AsyncSurrealDB(url=self.url)
+        await conn.connect()
+
+        # Reuse the token from the first sign-in; fall back if it has expired
+        if self._token:
+            try:
+                await conn.authenticate(self._token)
+            except Exception:
+                self._token = None
+        if not self._token:
+            self._token = await conn.sign_in(username=os.getenv('SURREAL_USER'), password=os.getenv('SURREAL_PASS'))
+        await conn.use(os.getenv('SURREAL_NAMESPACE'), os.getenv('SURREAL_DATABASE'))
+
+        return Session(conn)
 
 
-    async def ensure_connection(self: Self) -> None:
+    async def acquire(self: Self) -> Session:
+        """Check a healthy session out of the pool, connecting if needed."""
+        loop = asyncio.get_running_loop()
+        limit = self._limit(loop)
+        await limit.acquire()
         try:
-            # Connect to SurrealDB
-            await self.db.connect()
-            await self.db.sign_in(username=os.getenv('SURREAL_USER'), password=os.getenv('SURREAL_PASS'))
-            await self.db.use(os.getenv('SURREAL_NAMESPACE'), os.getenv('SURREAL_DATABASE'))
-
-            # Define schema
-            await self.db.query('''
-                -- Define user table
-                DEFINE TABLE user SCHEMAFULL;
-                DEFINE FIELD email ON user TYPE string;
-                DEFINE FIELD name ON user TYPE string;
-                DEFINE FIELD created_at ON user TYPE datetime;
-                DEFINE INDEX email_idx ON user COLUMNS email UNIQUE;
-
-                -- Define story table
-                DEFINE TABLE story SCHEMAFULL;
-                DEFINE FIELD title ON story TYPE string;
-                DEFINE FIELD prompt ON story TYPE string;
-                DEFINE FIELD created_at ON story TYPE string;
-                DEFINE FIELD updated_at ON story TYPE string;
-                DEFINE FIELD author ON story TYPE int;
-                DEFINE FIELD num_chapters ON story TYPE int;
-                DEFINE FIELD words_per_chapter ON story TYPE int;
-
-                -- Define chapter table
-                DEFINE TABLE chapter SCHEMAFULL;
-                DEFINE FIELD story ON chapter TYPE record<story>;
-                DEFINE FIELD chapter_number ON chapter TYPE int;
-                DEFINE FIELD content ON chapter TYPE string;
-                DEFINE FIELD created_at ON chapter TYPE string;
-                DEFINE FIELD updated_at ON chapter TYPE string;
-                DEFINE INDEX chapter_story_idx ON chapter COLUMNS story, chapter_number UNIQUE;
-
-                -- Define draft table
-                DEFINE TABLE draft SCHEMAFULL;
-                DEFINE FIELD title ON draft TYPE string;
-                DEFINE FIELD content ON draft TYPE string;
-                DEFINE FIELD prompt ON draft TYPE string;
-                DEFINE FIELD created_at ON draft TYPE datetime;
-                DEFINE FIELD updated_at ON draft TYPE datetime;
-                DEFINE FIELD author ON draft TYPE record<user>;
-                DEFINE FIELD published_story ON draft TYPE record<story>;
-            ''')
-        except Exception as e:
-            print(f"Database initialization error: {e}")
+            while self._idle:
+                session = self._idle.pop()
+                if session.loop is not loop or not session.reusable():
+                    session.discard()
+                    continue
+                if time.monotonic() - session.last_used > HEALTH_CHECK_INTERVAL and not await session.ping():
+                    session.discard()
+                    continue
+                return session
+            return await self._connect()
+        except Exception:
+            limit.release()
             raise
 
 
+    def release(self: Self, session: Session) -> None:
+        """Return a session to the pool, or close it if it is no longer usable."""
+        self._limit(session.loop).release()
+        if session.reusable() and len(self._idle) < self.size:
+            self._idle.append(session)
+        else:
+            session.discard()
+
+
+    @asynccontextmanager
+    async def session(self: Self):
+        session = await self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+
     async def query(self: Self, *args, **kwargs):
-        await self.ensure_connection()
-        return await self.db.query(*args, **kwargs)
+        async with self.session() as session:
+            return await session.query(*args, **kwargs)
+
+
+    async def close(self: Self) -> None:
+        """Close every idle session (used on shutdown and by scripts)."""
+        idle, self._idle = self._idle, []
+        loop = asyncio.get_running_loop()
+        for session in idle:
+            if session.loop is not loop:
+                session.discard()
+                continue
+            try:
+                await session.conn.close()
+            except:
+                logger.warning("Failed to close database connection", exc_info=True)
 
 
 # Create a singleton instance
-db = Database() 
\ No newline at end of file
+db = Database()
@@ -0,0 +1,59 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+import metrics
+import storage
+
+# Fragment name -> template; compiled once at startup and kept by Jinja
+FRAGMENTS = {
+    'chapter': 'fragments/chapter.html',
+    'chapter_audio': 'fragments/chapter_audio.html',
+    'story_title': 'fragments/story_title.html',
+    'audiobook_player': 'fragments/audiobook_player.html',
+}
+
+# How many rendered fragments to keep in memory
+FRAGMENT_CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE', '512'))
+
+# Everything a fragment depends on -> its HTML; changed inputs make a new key
+_cache: "OrderedDict[Tuple[Hashable, ...], str]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def preload(jinja_env) -> None:
+    """Compile every fragment template up front, so no request pays for it."""
+    for template in FRAGMENTS.values():
+        jinja_env.get_template(template)
+
+
+def chapter_key(story_id: str, chapter_number: int,
+                files: Dict[str, Any]) -> Tuple[Hashable, ...]:
+    """What a rendered chapter depends on: its text's version and its audio's."""
+    return (
+        'chapter', story_id, chapter_number,
+        storage.stamp_version(files.get('text')),
+        storage.stamp_version(files.get('audio')),
+    )
+
+
+def etag(key: Tuple[Hashable, ...]) -> str:
+    return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32]
+
+
+def get(key: Tuple[Hashable, ...]) -> Optional[str]:
+    with _cache_lock:
+        html = _cache.get(key)
+        if html is not None:
+            _cache.move_to_end(key)
+    metrics.FRAGMENT_CACHE_LOOKUPS.inc(result='hit' if html is not None else 'miss')
+    return html
+
+
+def put(key: Tuple[Hashable, ...], html: str) -> None:
+    with _cache_lock:
+        _cache[key] = html
+        _cache.move_to_end(key)
+        while len(_cache) > FRAGMENT_CACHE_SIZE:
+            _cache.popitem(last=False)
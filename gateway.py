@@ -0,0 +1,310 @@
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
+import anthropic as anthropic_sdk
+import openai as openai_sdk
+from dotenv import load_dotenv
+import metrics
+import tracing
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Longest a backoff may wait, whatever Retry-After says
+MAX_BACKOFF = float(os.getenv('PROVIDER_MAX_BACKOFF', '60'))
+# Consecutive failures that open a provider's circuit, and how long it stays open
+BREAKER_FAILURES = int(os.getenv('PROVIDER_BREAKER_FAILURES', '5'))
+BREAKER_RESET = float(os.getenv('PROVIDER_BREAKER_RESET', '30'))
+# Longest a streaming response may go without sending anything
+STREAM_IDLE_TIMEOUT = float(os.getenv('PROVIDER_STREAM_IDLE_TIMEOUT', '60'))
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+class ProviderUnavailable(Exception):
+    """The provider's circuit is open after repeated failures."""
+
+
+class TokenBucket:
+    """A per-minute allowance that refills continuously.
+
+    A rate of 0 means no limit. Requests larger than the whole allowance
+    wait for a full bucket rather than forever.
+    """
+
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float) -> None:
+        if not self.capacity:
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def adjust(self, amount: float) -> None:
+        """Charge (or refund, if negative) the difference between an estimate and actual use."""
+        if not self.capacity:
+            return
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class CircuitBreaker:
+    """Fail fast after repeated failures, letting one trial call through after a pause."""
+
+    def __init__(self, failures: int = BREAKER_FAILURES, reset_after: float = BREAKER_RESET) -> None:
+        self.max_failures = failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial: Optional[object] = None
+        self._lock = threading.Lock()
+
+    def check(self, name: str) -> Optional[object]:
+        """Raise while the circuit is open; returns a token if this call is the trial."""
+        with self._lock:
+            if self.opened_at is None:
+                return None
+            if time.monotonic() - self.opened_at >= self.reset_after and self._trial is None:
+                self._trial = object()
+                return self._trial
+        raise ProviderUnavailable(f"{name} is unavailable after repeated failures; try again shortly")
+
+    def end_trial(self, trial: Optional[object]) -> None:
+        """Let another call through if the trial ended without a verdict, e.g. cancelled."""
+        with self._lock:
+            if trial is not None and self._trial is trial:
+                self._trial = None
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial is not None or self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+            self._trial = None
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, anthropic_sdk.APIConnectionError, openai_sdk.APIConnectionError)):
+        return True
+    status = getattr(error, 'status_code', None)
+    return status is not None and (status in RETRYABLE_STATUS or status >= 500)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Seconds the provider asked us to wait, if it said."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff for the given (1-based) attempt."""
+    return random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+
+
+class Provider:
+    """One provider's client, shared by all generation code.
+
+    Calls wait for room in the requests-per-minute and tokens-per-minute
+    buckets, retry rate limits and server errors with jittered exponential
+    backoff (honouring Retry-After), give up at a deadline, and fail fast
+    while the circuit breaker is open.
+    """
+
+    def __init__(self, name: str, client: Any, rpm: int, tpm: int, attempts: int, deadline: float) -> None:
+        self.name = name
+        self.client = client
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.breaker = CircuitBreaker()
+        self.attempts = attempts
+        self.deadline = deadline
+
+    async def _admit(self, tokens: int) -> None:
+        await self.requests.acquire(1)
+        await self.tokens.acquire(tokens)
+
+    async def _retry(self, attempt: int, error: BaseException, give_up_at: float) -> None:
+        """Wait before the next attempt, or re-raise if there shouldn't be one."""
+        if not is_retryable(error):
+            # A bad request says nothing bad about the provider's health: it answered
+            self.breaker.record_success()
+            raise error
+        self.breaker.record_failure()
+        if attempt >= self.attempts:
+            raise error
+        delay = min(MAX_BACKOFF, retry_after(error) or backoff(attempt))
+        if time.monotonic() + delay >= give_up_at:
+            raise error
+        logger.warning("%s call failed (%r); retry %d in %.1fs", self.name, error, attempt, delay)
+        metrics.PROVIDER_RETRIES.inc(provider=self.name)
+        await asyncio.sleep(delay)
+
+    async def call(self, request: Callable[[Any], Awaitable[Any]], tokens: int = 0,
+                   deadline: Optional[float] = None) -> Any:
+        """Make a request, given as a function of the client, within limits and with retries.
+
+        ``tokens`` is the call's estimated quota use; if the result reports
+        its actual usage, the difference is settled afterwards.
+        """
+        give_up_at = time.monotonic() + (deadline or self.deadline)
+        with tracing.span('provider_call', provider=self.name, kind='call', tokens=tokens) as span, \
+                metrics.PROVIDER_CALL_SECONDS.time(provider=self.name, kind='call'), self._count_failure():
+            trial = None
+            try:
+                for attempt in range(1, self.attempts + 1):
+                    span.set(attempts=attempt)
+                    trial = self.breaker.check(self.name) or trial
+                    await self._admit(tokens)
+                    try:
+                        result = await asyncio.wait_for(request(self.client), give_up_at - time.monotonic())
+                    except (asyncio.CancelledError, ProviderUnavailable):
+                        raise
+                    except Exception as e:
+                        await self._retry(attempt, e, give_up_at)
+                        continue
+                    self.breaker.record_success()
+                    self.settle(tokens, getattr(result, 'usage', None))
+                    return result
+            finally:
+                self.breaker.end_trial(trial)
+
+    @contextmanager
+    def _count_failure(self) -> Iterator[None]:
+        try:
+            yield
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.PROVIDER_ERRORS.inc(provider=self.name, error=type(e).__name__)
+            raise
+
+    @asynccontextmanager
+    async def stream(self, request: Callable[[Any], Any], tokens: int = 0,
+                     deadline: Optional[float] = None) -> AsyncIterator[Any]:
+        """Open a streaming response within limits, retrying until the stream starts.
+
+        Failures after the first event aren't retried, since the caller may
+        already have used part of the response; a stalled stream fails after
+        STREAM_IDLE_TIMEOUT.
+        """
+        give_up_at = time.monotonic() + (deadline or self.deadline)
+        with tracing.span('provider_call', provider=self.name, kind='stream', tokens=tokens) as span, \
+                metrics.PROVIDER_CALL_SECONDS.time(provider=self.name, kind='stream'), self._count_failure():
+            trial = None
+            try:
+                for attempt in range(1, self.attempts + 1):
+                    span.set(attempts=attempt)
+                    trial = self.breaker.check(self.name) or trial
+                    await self._admit(tokens)
+                    manager = request(self.client)
+                    try:
+                        stream = await asyncio.wait_for(manager.__aenter__(), give_up_at - time.monotonic())
+                    except (asyncio.CancelledError, ProviderUnavailable):
+                        raise
+                    except Exception as e:
+                        await self._retry(attempt, e, give_up_at)
+                        continue
+                    break
+
+                try:
+                    yield stream
+                except BaseException as e:
+                    if isinstance(e, Exception) and is_retryable(e):
+                        self.breaker.record_failure()
+                    if not await manager.__aexit__(type(e), e, e.__traceback__):
+                        raise
+                else:
+                    self.breaker.record_success()
+                    await manager.__aexit__(None, None, None)
+            finally:
+                # A trial that was cancelled or failed without a verdict mustn't keep the circuit shut
+                self.breaker.end_trial(trial)
+
+    def settle(self, estimated: int, usage: Any) -> None:
+        """Correct the tokens-per-minute bucket once a call's real usage is known."""
+        if usage is None:
+            return
+        for field in ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens'):
+            count = getattr(usage, field, None)
+            if count:
+                metrics.LLM_TOKENS.inc(count, provider=self.name, kind=field.removesuffix('_tokens'))
+        used = sum(getattr(usage, field, None) or 0 for field in (
+            'input_tokens', 'output_tokens', 'cache_creation_input_tokens'
+        ))
+        if used:
+            self.tokens.adjust(used - estimated)
+
+
+# Quotas are per process; with several worker processes, divide the account's limits between them
+anthropic = Provider(
+    'anthropic',
+    anthropic_sdk.AsyncAnthropic(
+        api_key=os.getenv("ANTHROPIC_API_KEY"), max_retries=0, timeout=STREAM_IDLE_TIMEOUT
+    ),
+    rpm=int(os.getenv('ANTHROPIC_RPM', '50')),
+    tpm=int(os.getenv('ANTHROPIC_TPM', '80000')),
+    attempts=int(os.getenv('ANTHROPIC_ATTEMPTS', '5')),
+    deadline=float(os.getenv('ANTHROPIC_DEADLINE', '300')),
+)
+
+# For TTS, "tokens" are characters of input text
+openai = Provider(
+    'openai',
+    openai_sdk.AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"), max_retries=0, timeout=STREAM_IDLE_TIMEOUT
+    ),
+    rpm=int(os.getenv('OPENAI_TTS_RPM', '50')),
+    tpm=int(os.getenv('OPENAI_TTS_CHARS_PER_MINUTE', '0')),
+    attempts=int(os.getenv('OPENAI_ATTEMPTS', os.getenv('TTS_ATTEMPTS', '5'))),
+    deadline=float(os.getenv('OPENAI_DEADLINE', '180')),
+)
+
+
+async def close() -> None:
+    """Close both providers' HTTP connections, on shutdown."""
+    await asyncio.gather(anthropic.client.close(), openai.client.close(), return_exceptions=True)
@@ -0,0 +1,357 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Set, Tuple, Coroutine, TypeVar
+import audiogen
+import audiobook
+import chapter
+import metrics
+import storage
+import tracing
+
+# Number of jobs that may run at once in this process
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+
+# A running job that hasn't reported progress for this long is assumed to
+# belong to a dead process and is picked up again on startup
+JOB_STALE_AFTER = timedelta(minutes=int(os.getenv('JOB_STALE_MINUTES', '15')))
+
+# Chapters of one job that may be recorded at the same time, alongside writing
+PIPELINE_RECORDERS = int(os.getenv('PIPELINE_RECORDERS', '2'))
+
+ACTIVE_STATUSES = ['queued', 'running']
+
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+JOB_FIELDS = '''
+    record::id(id) AS id,
+    record::id(story) AS story_id,
+    kind,
+    status,
+    stage,
+    completed,
+    total,
+    error,
+    created_at,
+    updated_at
+'''
+
+
+async def create_job(db, story_id: str, kind: str = 'generate_all') -> Optional[Dict[str, Any]]:
+    """Create a queued job for a story, or return None if it already has an active one.
+
+    The job takes the story's job_lock record in the same transaction, and
+    a record id can only exist once, so two requests racing to start a job
+    can't both create one. A lock left by a finished job is released first.
+    """
+    now = datetime.utcnow().isoformat()
+    result = await db.query(f'''
+        BEGIN TRANSACTION;
+        DELETE type::thing('job_lock', $story_id) WHERE job.status NOT IN $statuses;
+        LET $job = (CREATE job SET
+            kind = $kind,
+            story = type::thing('story', $story_id),
+            status = 'queued',
+            stage = 'Waiting to start',
+            completed = 0,
+            total = 0,
+            created_at = $now,
+            updated_at = $now);
+        CREATE type::thing('job_lock', $story_id) SET job = $job[0].id;
+        SELECT {JOB_FIELDS} FROM $job;
+        COMMIT TRANSACTION;
+    ''', {
+        'kind': kind,
+        'story_id': story_id,
+        'statuses': ACTIVE_STATUSES,
+        'now': now
+    })
+
+    if not result or result[-1]["status"] == "ERR" or not result[-1]["result"]:
+        logger.debug("Not creating a job for %s: %s", story_id, result and result[-1].get("result"))
+        return None
+    return result[-1]["result"][0]
+
+
+async def start_job(db, story_id: str, kind: str = 'generate_all') -> Tuple[Dict[str, Any], bool]:
+    """The story's queued or running job, creating one if there isn't one; True if it was created."""
+    for _ in range(3):
+        job = await create_job(db, story_id, kind)
+        if job:
+            return job, True
+        # Lost the race, or the story already had a job: reuse it
+        job = await get_active_job(db, story_id)
+        if job:
+            return job, False
+    raise ValueError(f"Failed to create job for story {story_id}")
+
+
+async def get_job(db, job_id: str) -> Optional[Dict[str, Any]]:
+    result = await db.query(f'''
+        SELECT {JOB_FIELDS}
+        FROM type::thing('job', $job_id);
+    ''', {
+        'job_id': job_id
+    })
+
+    if not result or result[0]["status"] == "ERR" or not result[0]["result"]:
+        return None
+    return result[0]["result"][0]
+
+
+async def get_active_job(db, story_id: str) -> Optional[Dict[str, Any]]:
+    """Get the queued or running job for a story, if there is one."""
+    result = await db.query(f'''
+        SELECT {JOB_FIELDS}
+        FROM job
+        WHERE story = type::thing('story', $story_id)
+        AND status IN $statuses
+        ORDER BY created_at DESC
+        LIMIT 1;
+    ''', {
+        'story_id': story_id,
+        'statuses': ACTIVE_STATUSES
+    })
+
+    if not result or result[0]["status"] == "ERR" or not result[0]["result"]:
+        return None
+    return result[0]["result"][0]
+
+
+async def update_job(db, job_id: str, **fields) -> None:
+    fields['updated_at'] = datetime.utcnow().isoformat()
+    await db.query('''
+        UPDATE type::thing('job', $job_id) MERGE $fields;
+    ''', {
+        'job_id': job_id,
+        'fields': fields
+    })
+
+
+async def claim_job(db, job_id: str) -> bool:
+    """Atomically move a job from queued to running. False if someone else has it."""
+    result = await db.query('''
+        UPDATE type::thing('job', $job_id)
+        SET status = 'running', updated_at = $now
+        WHERE status = 'queued'
+        RETURN AFTER;
+    ''', {
+        'job_id': job_id,
+        'now': datetime.utcnow().isoformat()
+    })
+    return bool(result and result[0]["status"] == "OK" and result[0]["result"])
+
+
+async def cancel_job(db, job_id: str) -> None:
+    await db.query('''
+        UPDATE type::thing('job', $job_id)
+        SET status = 'cancelled', stage = 'Cancelled', updated_at = $now
+        WHERE status IN $statuses;
+    ''', {
+        'job_id': job_id,
+        'statuses': ACTIVE_STATUSES,
+        'now': datetime.utcnow().isoformat()
+    })
+
+
+async def requeue_interrupted_jobs(db) -> List[Dict[str, Any]]:
+    """Put jobs left behind by a crashed process back in the queue."""
+    cutoff = (datetime.utcnow() - JOB_STALE_AFTER).isoformat()
+    await db.query('''
+        UPDATE job SET status = 'queued'
+        WHERE status = 'running' AND updated_at < $cutoff;
+    ''', {
+        'cutoff': cutoff
+    })
+
+    result = await db.query(f'''
+        SELECT {JOB_FIELDS}
+        FROM job
+        WHERE status = 'queued'
+        ORDER BY created_at;
+    ''')
+    return result[0]["result"] if result and result[0]["result"] else []
+
+
+async def ensure_not_cancelled(db, job_id: str) -> None:
+    job = await get_job(db, job_id)
+    if not job or job["status"] == 'cancelled':
+        raise JobCancelled(job_id)
+
+
+async def generate_all(db, job_id: str, story_id: str) -> None:
+    """Write and record every chapter that is still missing.
+
+    Writing and recording run as two pipelined stages: each chapter only
+    needs the previous chapter's text, so the next chapter is written while
+    finished ones (and older chapters still missing audio) are recorded.
+    Each chapter's text and audio are saved as soon as they are produced,
+    and finished work is skipped, so re-running a failed or cancelled job
+    picks up where it left off.
+    """
+    chapters, num_chapters = await chapter.get_chapters_list(db, story_id)
+    existing = {c["chapter_number"] for c in chapters}
+    await update_job(db, job_id, total=num_chapters)
+
+    recordings: asyncio.Queue = asyncio.Queue()
+    finished = set()
+    stages: Dict[str, str] = {}
+
+    async def report(stage: str, text: Optional[str]) -> None:
+        if text:
+            stages[stage] = text
+        else:
+            stages.pop(stage, None)
+        await update_job(db, job_id, stage=', '.join(stages.values()) or 'Finishing',
+                         completed=len(finished))
+
+    async def write() -> None:
+        try:
+            for chapter_num in range(1, num_chapters + 1):
+                if chapter_num not in existing:
+                    await ensure_not_cancelled(db, job_id)
+                    await report('write', f"Writing chapter {chapter_num}")
+                    await chapter.generate_new_chapter(db, story_id, chapter_num)
+                if await storage.has_chapter_audio_async(story_id, chapter_num):
+                    finished.add(chapter_num)
+                else:
+                    recordings.put_nowait(chapter_num)
+            await report('write', None)
+        finally:
+            for _ in range(PIPELINE_RECORDERS):
+                recordings.put_nowait(None)
+
+    async def record() -> None:
+        while (chapter_num := await recordings.get()) is not None:
+            await ensure_not_cancelled(db, job_id)
+            await report(f'record-{chapter_num}', f"Recording chapter {chapter_num}")
+            content = await storage.get_chapter_text_async(story_id, chapter_num)
+            audio_bytes = await audiogen.generate_audio(content, story_id, chapter_num)
+            await chapter.save_chapter_audio(db, story_id, chapter_num, audio_bytes)
+            await storage.run_io(audiobook.refresh_audiobook, story_id)
+            finished.add(chapter_num)
+            await report(f'record-{chapter_num}', None)
+
+    tasks = [asyncio.create_task(write())]
+    tasks += [asyncio.create_task(record()) for _ in range(PIPELINE_RECORDERS)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # One failed stage stops the others; finished chapters stay saved
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+JOB_HANDLERS = {
+    'generate_all': generate_all,
+}
+
+
+class JobQueue:
+    """A bounded pool of async workers on the server's event loop.
+
+    Started and stopped by the app's serving hooks, so jobs share the
+    worker process's long-lived loop (and the provider clients' connections)
+    with the requests that start them. Jobs still running at shutdown are
+    put back in the queue for the next process to resume.
+    """
+
+    def __init__(self, db, workers: int = JOB_WORKERS) -> None:
+        self.db = db
+        self.workers = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._background: Set[asyncio.Task] = set()
+        self._stopping = False
+
+    async def start(self) -> None:
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+        try:
+            for job in await requeue_interrupted_jobs(self.db):
+                logger.info("Resuming job %s for story %s", job['id'], job['story_id'])
+                self._queue.put_nowait((job["id"], job["kind"], job["story_id"]))
+        except Exception as e:
+            logger.error("Error resuming interrupted jobs: %s", e)
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Interrupt running jobs and background work, and stop the workers."""
+        if self._queue is None:
+            return
+        self._stopping = True
+        for task in list(self._tasks.values()) + list(self._background):
+            task.cancel()
+        for _ in self._workers:
+            self._queue.put_nowait(None)
+        # Workers requeue the jobs they were running before they exit
+        done, pending = await asyncio.wait(self._workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*self._background, *pending, return_exceptions=True)
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> "asyncio.Task[T]":
+        """Run a coroutine as a task that doesn't depend on the request that started it.
+
+        Await the task through asyncio.shield, so that a client going away
+        doesn't cancel the generation it asked for.
+        """
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def submit(self, job: Dict[str, Any]) -> None:
+        self._queue.put_nowait((job["id"], job["kind"], job["story_id"]))
+
+    def cancel(self, job_id: str) -> None:
+        task = self._tasks.get(job_id)
+        if task:
+            task.cancel()
+
+    async def _worker(self) -> None:
+        while (item := await self._queue.get()) is not None and not self._stopping:
+            job_id, kind, story_id = item
+            try:
+                if not await claim_job(self.db, job_id):
+                    continue
+                # Each job is a trace of its own; the task inherits the span
+                with tracing.span(f'job.{kind}', job_id=job_id, story_id=story_id) as span:
+                    task = asyncio.create_task(JOB_HANDLERS[kind](self.db, job_id, story_id))
+                    self._tasks[job_id] = task
+                    try:
+                        with metrics.IN_PROGRESS.track(kind='job'):
+                            await task
+                        await update_job(self.db, job_id, status='done', stage='Finished')
+                        logger.info("Job %s finished", job_id)
+                    except (JobCancelled, asyncio.CancelledError) as e:
+                        if self._stopping and not isinstance(e, JobCancelled):
+                            # Shutting down, not cancelled: the next process picks it up
+                            await update_job(self.db, job_id, status='queued', stage='Interrupted; resuming shortly')
+                            span.set(interrupted=True)
+                            logger.info("Job %s interrupted by shutdown", job_id)
+                        else:
+                            await update_job(self.db, job_id, status='cancelled', stage='Cancelled')
+                            span.set(cancelled=True)
+                            logger.info("Job %s cancelled", job_id)
+                    except Exception as e:
+                        span.fail(e)
+                        logger.error("Job %s failed: %s", job_id, e)
+                        await update_job(self.db, job_id, status='failed', stage='Failed', error=str(e))
+            except Exception as e:
+                logger.error("Error running job %s: %s", job_id, e)
+            finally:
+                self._tasks.pop(job_id, None)
+                self._queue.task_done()
@@ -0,0 +1,154 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+# Seconds; wide enough for both a DB query and a whole chapter
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_registry: List["Metric"] = []
+
+
+def label_key(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    """A named metric with one series per label set. Updates are a dict write under a lock."""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{format_labels(key)} {format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels) -> Iterator[None]:
+        """Count something as in progress for the duration of the block."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+        # label set -> [per-bucket counts (last is +Inf), sum]
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(key, (('le', format_value(bound)),))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(key)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(key)} {cumulative}"
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format."""
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+# Metrics are per process; Prometheus should scrape each worker
+
+HTTP_REQUEST_SECONDS = Histogram('storymode_http_request_seconds', 'Time to handle an HTTP request')
+DB_QUERY_SECONDS = Histogram('storymode_db_query_seconds', 'SurrealDB query latency')
+DB_ERRORS = Counter('storymode_db_errors_total', 'SurrealDB queries that failed')
+
+PROVIDER_CALL_SECONDS = Histogram('storymode_provider_call_seconds', 'Anthropic/OpenAI call latency, retries included')
+PROVIDER_RETRIES = Counter('storymode_provider_retries_total', 'Provider calls retried after an error')
+PROVIDER_ERRORS = Counter('storymode_provider_errors_total', 'Provider calls that failed for good')
+LLM_TOKENS = Counter('storymode_llm_tokens_total', 'Tokens reported by Anthropic, by kind')
+
+TTS_CHUNK_SECONDS = Histogram('storymode_tts_chunk_seconds', 'Time to synthesize one TTS chunk')
+TTS_CHUNKS = Counter('storymode_tts_chunks_total', 'TTS chunks, by whether they came from the cache or the API')
+TTS_CHARACTERS = Counter('storymode_tts_characters_total', 'Characters sent to the TTS API')
+AUDIO_PROCESS_SECONDS = Histogram('storymode_audio_process_seconds', 'Time spent joining, decoding or encoding audio')
+
+STORAGE_SECONDS = Histogram('storymode_storage_seconds', 'File read/write latency')
+STORAGE_BYTES = Counter('storymode_storage_bytes_total', 'Bytes read from or written to disk')
+TEXT_CACHE_LOOKUPS = Counter('storymode_text_cache_lookups_total', 'Chapter text cache lookups, by result')
+FRAGMENT_CACHE_LOOKUPS = Counter('storymode_fragment_cache_lookups_total', 'Rendered fragment lookups, by result')
+READ_CACHE_LOOKUPS = Counter('storymode_read_cache_lookups_total', 'Home page and chapters list cache lookups, by result')
+
+IN_PROGRESS = Gauge('storymode_generations_in_progress', 'Chapters, audio and jobs being generated right now')
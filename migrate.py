@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import logging
+import re
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).parent / 'migrations'
+
+# Migrations up to this version predate the tracking table. A database that
+# already has a schema but no tracking rows is assumed to have them applied.
+BASELINE_VERSION = 4
+
+# How long a runner may hold the lock before another process takes it over
+LOCK_TIMEOUT = timedelta(minutes=5)
+LOCK_POLL_INTERVAL = 1.0
+
+
+def list_migrations() -> List[Tuple[int, str, Path]]:
+    """Return (version, name, path) for every migration file, in order."""
+    migrations = []
+    for path in MIGRATIONS_DIR.glob('*.surql'):
+        match = re.match(r'^(\d+)_(.+)$', path.stem)
+        if not match:
+            logger.warning("Skipping migration with no version prefix: %s", path.name)
+            continue
+        migrations.append((int(match.group(1)), match.group(2), path))
+    return sorted(migrations)
+
+
+def check(result, action: str):
+    """Raise if any statement in a SurrealDB response failed."""
+    for statement in result or []:
+        if statement.get("status") == "ERR":
+            raise ValueError(f"Failed to {action}: " + str(statement.get("result", "Unknown error")))
+    return result
+
+
+async def ensure_tracking_table(db) -> None:
+    check(await db.query('''
+        DEFINE TABLE IF NOT EXISTS migration SCHEMAFULL;
+        DEFINE FIELD IF NOT EXISTS version ON migration TYPE int;
+        DEFINE FIELD IF NOT EXISTS name ON migration TYPE string;
+        DEFINE FIELD IF NOT EXISTS checksum ON migration TYPE string;
+        DEFINE FIELD IF NOT EXISTS applied_at ON migration TYPE string;
+        DEFINE INDEX IF NOT EXISTS migration_version_idx ON migration COLUMNS version UNIQUE;
+
+        DEFINE TABLE IF NOT EXISTS migration_lock SCHEMALESS;
+    '''), "create migration tracking table")
+
+
+async def get_applied_versions(db) -> set:
+    result = check(await db.query('SELECT version FROM migration;'), "read applied migrations")
+    return {row["version"] for row in result[0]["result"] or []}
+
+
+async def has_existing_schema(db) -> bool:
+    result = check(await db.query('INFO FOR DB;'), "inspect database")
+    return 'story' in (result[0]["result"] or {}).get("tables", {})
+
+
+async def acquire_lock(db, owner: str) -> None:
+    """Take the single migration lock, waiting for (or expiring) other holders."""
+    while True:
+        now = datetime.utcnow()
+        result = await db.query('''
+            CREATE migration_lock:runner SET
+                owner = $owner,
+                expires_at = $expires_at;
+        ''', {
+            'owner': owner,
+            'expires_at': (now + LOCK_TIMEOUT).isoformat()
+        })
+        if result and result[0]["status"] == "OK":
+            return
+
+        # Someone else holds it; steal it only once it has expired
+        await db.query('''
+            DELETE migration_lock:runner WHERE expires_at < $now;
+        ''', {
+            'now': now.isoformat()
+        })
+        logger.info("Waiting for migration lock...")
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+
+
+async def release_lock(db, owner: str) -> None:
+    await db.query('''
+        DELETE migration_lock:runner WHERE owner = $owner;
+    ''', {
+        'owner': owner
+    })
+
+
+async def record_migration(db, version: int, name: str, checksum: str) -> None:
+    check(await db.query('''
+        CREATE type::thing('migration', $version) SET
+            version = $version,
+            name = $name,
+            checksum = $checksum,
+            applied_at = $now;
+    ''', {
+        'version': version,
+        'name': name,
+        'checksum': checksum,
+        'now': datetime.utcnow().isoformat()
+    }), f"record migration {version}")
+
+
+async def apply_migration(db, version: int, name: str, path: Path) -> None:
+    sql = path.read_text(encoding='utf-8')
+    checksum = hashlib.sha256(path.read_bytes()).hexdigest()
+    logger.info("Applying migration %s", path.name)
+    check(await db.query(sql), f"apply migration {path.name}")
+    await record_migration(db, version, name, checksum)
+
+
+async def run_migrations(db) -> int:
+    """Apply every pending migration under a lock. Returns how many ran."""
+    async with db.session() as session:
+        await ensure_tracking_table(session)
+
+        # Fast path: nothing to do, so don't bother with the lock
+        migrations = list_migrations()
+        applied = await get_applied_versions(session)
+        if all(version in applied for version, _, _ in migrations):
+            return 0
+
+        owner = uuid.uuid4().hex
+        await acquire_lock(session, owner)
+        try:
+            # Another process may have finished while we waited for the lock
+            applied = await get_applied_versions(session)
+            if not applied and await has_existing_schema(session):
+                logger.info("Existing schema found; marking migrations up to %d as applied", BASELINE_VERSION)
+                for version, name, path in migrations:
+                    if version <= BASELINE_VERSION:
+                        checksum = hashlib.sha256(path.read_bytes()).hexdigest()
+                        await record_migration(session, version, name, checksum)
+                        applied.add(version)
+
+            count = 0
+            for version, name, path in migrations:
+                if version in applied:
+                    continue
+                await apply_migration(session, version, name, path)
+                count += 1
+            logger.info("Applied %d migration(s)", count)
+            return count
+        finally:
+            await release_lock(session, owner)
+
+
+if __name__ == "__main__":
+    import tracing
+    from db import db
+
+    tracing.configure_logging()
+
+    async def main():
+        try:
+            await run_migrations(db)
+        finally:
+            await db.close()
+
+    asyncio.run(main())
@@ -1,5 +1,7 @@
 import asyncio
 from typing import Optional, Tuple, List
+import chapter
+import mp3
 import storage
 
 async def migrate_chapter(db, story_id: str, chapter_number: int) -> bool:
@@ -130,4 +132,43 @@ async def migrate_all_chapters(db) -> None:
             failed += 1
             print(f"Failed to migrate chapter {chapter_number}")
 
-    print(f"Storage migration complete. Succeeded: {succeeded}, Failed: {failed}, Total: {total}") 
\ No newline at end of file
+    print(f"Storage migration complete. Succeeded: {succeeded}, Failed: {failed}, Total: {total}")
+
+
+async def backfill_audio_metadata(db) -> None:
+    """Record length, format and hash on chapters whose audio was saved before the database tracked them."""
+    chapters = await db.query('''
+        SELECT record::id(story) AS story_id, chapter_number
+        FROM chapter
+        WHERE audio_sha256 = NONE;
+    ''')
+    if not chapters or chapters[0]["status"] != "OK":
+        raise ValueError("SurrealDB Error: " + str(chapters and chapters[0]["result"]))
+
+    updated = 0
+    for row in chapters[0]["result"]:
+        story_id, chapter_number = row['story_id'], row['chapter_number']
+        if not storage.has_chapter_audio(story_id, chapter_number):
+            continue
+        # Files saved before probing was added are probed here, headers only
+        audio = storage.get_chapter_audio_info(story_id, chapter_number)
+        if audio is None:
+            audio = mp3.probe_file(storage.get_chapter_audio_path(story_id, chapter_number))
+            storage.record_file(story_id, chapter_number, 'audio', audio)
+        await chapter.record_chapter_audio(db, story_id, chapter_number, audio)
+        updated += 1
+    print(f"Recorded audio details for {updated} chapter(s)")
+
+if __name__ == "__main__":
+    from db import db
+
+    async def main():
+        try:
+            # Move chapter content and audio out of the database first, then
+            # record details of the audio files now on disk
+            await migrate_all_chapters(db)
+            await backfill_audio_metadata(db)
+        finally:
+            await db.close()
+
+    asyncio.run(main())
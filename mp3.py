@@ -0,0 +1,338 @@
+import hashlib
+import struct
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# Bitrates in kbps for Layer III, indexed by the header's bitrate index
+MPEG1_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MPEG2_BITRATES = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+
+# Sample rates indexed by [version bits][sample rate index]
+SAMPLE_RATES = {
+    0b11: [44100, 48000, 32000],  # MPEG 1
+    0b10: [22050, 24000, 16000],  # MPEG 2
+    0b00: [11025, 12000, 8000],   # MPEG 2.5
+}
+
+MONO = 0b11
+XING_FRAMES = 0x0001
+XING_FLAGS = XING_FRAMES | 0x0002 | 0x0004  # frames, bytes, TOC
+
+# How much of a file past its ID3 tag probe_file reads to find the first frame
+PROBE_BYTES = 64 * 1024
+
+
+@dataclass(frozen=True)
+class FrameHeader:
+    """A decoded MPEG audio Layer III frame header."""
+    version: int         # raw version bits: 3 = MPEG 1, 2 = MPEG 2, 0 = MPEG 2.5
+    bitrate_index: int
+    sample_rate_index: int
+    padding: int
+    channel_mode: int
+    mode_extension: int
+    protected: bool
+
+    @property
+    def mpeg1(self) -> bool:
+        return self.version == 0b11
+
+    @property
+    def bitrate(self) -> int:
+        return (MPEG1_BITRATES if self.mpeg1 else MPEG2_BITRATES)[self.bitrate_index]
+
+    @property
+    def sample_rate(self) -> int:
+        return SAMPLE_RATES[self.version][self.sample_rate_index]
+
+    @property
+    def samples(self) -> int:
+        return 1152 if self.mpeg1 else 576
+
+    @property
+    def length(self) -> int:
+        """Frame length in bytes, header included."""
+        return (144000 if self.mpeg1 else 72000) * self.bitrate // self.sample_rate + self.padding
+
+    @property
+    def side_info_size(self) -> int:
+        if self.mpeg1:
+            return 17 if self.channel_mode == MONO else 32
+        return 9 if self.channel_mode == MONO else 17
+
+    @property
+    def stream_format(self) -> Tuple[int, int, int]:
+        """What must match for two streams to be joined frame by frame."""
+        return (self.version, self.sample_rate_index, self.channel_mode == MONO)
+
+    def to_bytes(self) -> bytes:
+        return bytes([
+            0xFF,
+            0xE0 | self.version << 3 | 0b01 << 1 | (0 if self.protected else 1),
+            self.bitrate_index << 4 | self.sample_rate_index << 2 | self.padding << 1,
+            self.channel_mode << 6 | self.mode_extension << 4,
+        ])
+
+
+def parse_header(data: bytes, offset: int) -> Optional[FrameHeader]:
+    """Decode the frame header at offset, or None if there isn't a valid one."""
+    if offset + 4 > len(data):
+        return None
+    b0, b1, b2, b3 = data[offset:offset + 4]
+    if b0 != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+
+    version = (b1 >> 3) & 0b11
+    layer = (b1 >> 1) & 0b11
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0b11
+    # Only Layer III with a fixed bitrate is supported
+    if version == 0b01 or layer != 0b01 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    return FrameHeader(
+        version=version,
+        bitrate_index=bitrate_index,
+        sample_rate_index=sample_rate_index,
+        padding=(b2 >> 1) & 1,
+        channel_mode=b3 >> 6,
+        mode_extension=(b3 >> 4) & 0b11,
+        protected=not (b1 & 1),
+    )
+
+
+def id3v2_size(data: bytes) -> int:
+    """Size of a leading ID3v2 tag, or 0 if there is none."""
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = size << 7 | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def is_info_frame(data: bytes, offset: int, header: FrameHeader) -> bool:
+    """Whether the frame is a Xing/Info/VBRI header rather than audio."""
+    xing = offset + 4 + header.side_info_size
+    if data[xing:xing + 4] in (b'Xing', b'Info'):
+        return True
+    return data[offset + 36:offset + 40] == b'VBRI'
+
+
+def synced_header(data: bytes, offset: int, end: int) -> Optional[FrameHeader]:
+    """The frame header at offset, if the next frame lines up after it too.
+
+    Checking the next frame keeps stray 0xFF bytes from being taken as sync.
+    """
+    header = parse_header(data, offset)
+    if header is None or offset + header.length > end or (
+        offset + header.length + 4 <= end and parse_header(data, offset + header.length) is None
+    ):
+        return None
+    return header
+
+
+def audio_end(data: bytes) -> int:
+    """Where the audio ends: before a trailing ID3v1 tag, if there is one."""
+    end = len(data)
+    if end >= 128 and data[end - 128:end - 125] == b'TAG':
+        end -= 128
+    return end
+
+
+def iter_frames(data: bytes) -> Iterator[Tuple[int, FrameHeader]]:
+    """Yield (offset, header) for each audio frame, skipping tags and VBR headers."""
+    offset = id3v2_size(data)
+    end = audio_end(data)
+
+    first = True
+    while offset + 4 <= end:
+        header = synced_header(data, offset, end)
+        if header is None:
+            offset += 1
+            continue
+
+        if not (first and is_info_frame(data, offset, header)):
+            yield offset, header
+        first = False
+        offset += header.length
+
+
+def vbr_frames(data: bytes, offset: int, header: FrameHeader) -> Optional[int]:
+    """The audio frame count from a Xing/Info or VBRI header frame, if it gives one."""
+    xing = offset + 4 + header.side_info_size
+    if data[xing:xing + 4] in (b'Xing', b'Info') and len(data) >= xing + 12:
+        flags, frames = struct.unpack('>II', data[xing + 4:xing + 12])
+        return frames if flags & XING_FRAMES else None
+    vbri = offset + 36
+    if data[vbri:vbri + 4] == b'VBRI' and len(data) >= vbri + 18:
+        frames, = struct.unpack('>I', data[vbri + 14:vbri + 18])
+        return frames
+    return None
+
+
+@dataclass(frozen=True)
+class AudioInfo:
+    """What a player or the audiobook needs to know about an MP3, without decoding it."""
+    duration_ms: int
+    bitrate: int         # average, in kbps
+    sample_rate: int
+    channels: int
+    size: int            # bytes, tags included
+    sha256: str
+
+
+def read_info(head: bytes, end: int) -> Tuple[int, int, int, int]:
+    """(duration ms, kbps, sample rate, channels) from the start of a stream whose audio ends at ``end``.
+
+    Streams with a Xing/Info or VBRI header are timed from its frame count;
+    anything else is taken to be constant bitrate and timed from the first
+    frame's bitrate and the audio's size.
+    """
+    offset = id3v2_size(head)
+    while offset + 4 <= min(end, len(head)):
+        header = synced_header(head, offset, end)
+        if header is not None:
+            break
+        offset += 1
+    else:
+        raise ValueError("No MP3 audio frames found")
+
+    channels = 1 if header.channel_mode == MONO else 2
+    frames = None
+    if is_info_frame(head, offset, header):
+        frames = vbr_frames(head, offset, header)
+        offset += header.length
+    audio_bytes = end - offset
+    if frames:
+        duration = frames * header.samples * 1000 // header.sample_rate
+        bitrate = round(audio_bytes * 8 / duration) if duration else header.bitrate
+        return duration, bitrate, header.sample_rate, channels
+    return audio_bytes * 8 // header.bitrate, header.bitrate, header.sample_rate, channels
+
+
+def probe(data: bytes) -> AudioInfo:
+    """Describe an MP3 from its headers; only the hash reads the whole file."""
+    duration, bitrate, sample_rate, channels = read_info(data, audio_end(data))
+    return AudioInfo(duration, bitrate, sample_rate, channels, len(data), hashlib.sha256(data).hexdigest())
+
+
+def probe_file(path: Path) -> AudioInfo:
+    """probe for a file on disk, reading only its headers and streaming the hash."""
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+        f.seek(0)
+        head = f.read(10)
+        head += f.read(id3v2_size(head) + PROBE_BYTES - len(head))
+        end = size
+        if size >= 128:
+            f.seek(size - 128)
+            if f.read(3) == b'TAG':
+                end -= 128
+        f.seek(0)
+        digest = hashlib.file_digest(f, 'sha256')
+    duration, bitrate, sample_rate, channels = read_info(head, end)
+    return AudioInfo(duration, bitrate, sample_rate, channels, size, digest.hexdigest())
+
+
+def silence_frame(header: FrameHeader) -> bytes:
+    """A frame that decodes to silence: zero side info and no main data."""
+    silent = replace(header, padding=0, mode_extension=0, protected=False)
+    return silent.to_bytes() + bytes(silent.length - 4)
+
+
+def silence_frame_count(header: FrameHeader, duration_ms: int) -> int:
+    """How many frames of the stream's format cover the given duration."""
+    return -(-duration_ms * header.sample_rate // (1000 * header.samples))
+
+
+def xing_header(header: FrameHeader) -> FrameHeader:
+    """The header for a Xing frame in the stream's format: the smallest bitrate that fits the tag."""
+    payload_size = 4 + 4 + 4 + 4 + 100
+    for bitrate_index in range(1, 15):
+        candidate = replace(header, bitrate_index=bitrate_index, padding=0, mode_extension=0, protected=False)
+        if candidate.length >= 4 + candidate.side_info_size + payload_size:
+            break
+    return candidate
+
+
+def seek_table(spans: List[Tuple[int, int]]) -> bytes:
+    """A 100-entry Xing seek table for (frame count, byte count) spans laid end to end.
+
+    Positions inside a span are interpolated, so one span per frame gives an
+    exact table and one span per chapter a close one.
+    """
+    total_frames = sum(frames for frames, _ in spans)
+    total_bytes = sum(size for _, size in spans)
+    toc = bytearray(100)
+    if not total_frames or not total_bytes:
+        return bytes(toc)
+
+    span = 0
+    frames_before = bytes_before = 0
+    for percent in range(100):
+        target = percent * total_frames / 100
+        while span < len(spans) - 1 and frames_before + spans[span][0] <= target:
+            frames_before += spans[span][0]
+            bytes_before += spans[span][1]
+            span += 1
+        frames, size = spans[span]
+        position = bytes_before + (size * (target - frames_before) / frames if frames else 0)
+        toc[percent] = min(255, int(position * 256 / total_bytes))
+    return bytes(toc)
+
+
+def xing_frame(header: FrameHeader, spans: List[Tuple[int, int]], vbr: bool) -> bytes:
+    """Build a Xing (or, for constant bitrate, Info) header frame.
+
+    The frame describes the audio that follows it: frame count, byte count and
+    a 100-entry seek table so players can seek and show the right duration.
+    """
+    header = xing_header(header)
+    total_frames = sum(frames for frames, _ in spans)
+    total_bytes = sum(size for _, size in spans) + header.length
+
+    tag = (b'Xing' if vbr else b'Info') + struct.pack('>III', XING_FLAGS, total_frames, total_bytes) + seek_table(spans)
+    frame = header.to_bytes() + bytes(header.side_info_size) + tag
+    return frame + bytes(header.length - len(frame))
+
+
+def concatenate(streams: Iterable[bytes], gap_ms: int = 0) -> bytes:
+    """Join same-format MP3 streams by copying frames, without re-encoding.
+
+    ID3 tags and per-file Xing/Info headers are dropped, ``gap_ms`` of
+    silence is placed between streams, and a single new Xing header is written
+    for the result. Raises ValueError if the streams can't be joined as-is.
+    """
+    chunks: List[bytes] = []
+    frame_sizes: List[int] = []
+    first_header: Optional[FrameHeader] = None
+    bitrates = set()
+
+    for data in streams:
+        stream_frames = list(iter_frames(data))
+        if not stream_frames:
+            raise ValueError("No MP3 audio frames found")
+
+        if first_header is None:
+            first_header = stream_frames[0][1]
+        elif gap_ms:
+            frame = silence_frame(first_header)
+            count = silence_frame_count(first_header, gap_ms)
+            chunks.append(frame * count)
+            frame_sizes.extend([len(frame)] * count)
+
+        for offset, header in stream_frames:
+            if header.stream_format != first_header.stream_format:
+                raise ValueError("MP3 streams have different formats")
+            bitrates.add(header.bitrate)
+            chunks.append(data[offset:offset + header.length])
+            frame_sizes.append(header.length)
+
+    if first_header is None:
+        raise ValueError("No MP3 streams to concatenate")
+
+    spans = [(1, size) for size in frame_sizes]
+    return xing_frame(first_header, spans, vbr=len(bitrates) > 1) + b''.join(chunks)
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import secrets
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Hashable, Optional, Tuple
+import metrics
+import storage
+
+# Seconds a cached read model is served for if nothing invalidates it, e.g.
+# after a deploy changes a template. Windows are aligned to the wall clock,
+# so every worker process expires its copy, and its ETag, at the same time.
+READ_CACHE_TTL = float(os.getenv('READ_CACHE_TTL', '60'))
+
+Key = Tuple[Hashable, ...]
+
+HOME = ('home',)
+
+
+def chapters_list_key(story_id: str) -> Key:
+    return ('chapters_list', story_id)
+
+
+class Entry:
+    __slots__ = ('value', 'version', 'expires')
+
+    def __init__(self, value: Any, version: str, expires: float) -> None:
+        self.value = value
+        self.version = version
+        self.expires = expires
+
+
+_entries: Dict[Key, Entry] = {}
+_lock = threading.Lock()
+
+
+def ttl_window() -> int:
+    """The current TTL window, the same in every process."""
+    return int(time.time() // READ_CACHE_TTL)
+
+
+def version_path(key: Key) -> Path:
+    """The file whose identity is the key's version, shared by every worker process."""
+    return storage.get_user_data_dir() / 'read-cache' / '-'.join(str(part) for part in key)
+
+
+def version(key: Key) -> str:
+    """The key's current version; take it before loading a value and pass it to put."""
+    try:
+        stat = version_path(key).stat()
+    except FileNotFoundError:
+        return '0'
+    # Each bump replaces the file, so the inode changes even within one mtime tick
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}"
+
+
+def etag(key: Key, key_version: str) -> str:
+    return hashlib.sha256(repr((key, key_version, ttl_window())).encode('utf-8')).hexdigest()[:32]
+
+
+def get(key: Key, key_version: str) -> Optional[Entry]:
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and (entry.version != key_version or entry.expires <= time.time()):
+            del _entries[key]
+            entry = None
+    metrics.READ_CACHE_LOOKUPS.inc(cache=key[0], result='hit' if entry else 'miss')
+    return entry
+
+
+def put(key: Key, value: Any, loaded_at: str) -> Entry:
+    """Cache a freshly loaded value under the version it was loaded at, until its TTL window ends.
+
+    A load that raced a write keeps its old version, so the next get
+    misses instead of serving it.
+    """
+    entry = Entry(value, loaded_at, (ttl_window() + 1) * READ_CACHE_TTL)
+    with _lock:
+        _entries[key] = entry
+    return entry
+
+
+def invalidate(*keys: Key) -> None:
+    """Bump the keys' versions, in every process, by replacing their version files."""
+    for key in keys:
+        path = version_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp = path.with_name(f"{path.name}.{secrets.token_hex(4)}.tmp")
+        temp.write_bytes(b'')
+        os.replace(temp, path)
+        with _lock:
+            _entries.pop(key, None)
+
+
+def invalidate_story(story_id: str) -> None:
+    """Drop every cached read model that shows this story."""
+    invalidate(HOME, chapters_list_key(story_id))
@@ -1,81 +1,431 @@
+import asyncio
+import contextvars
+import dataclasses
+import fcntl
+import functools
+import json
+import logging
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, TypeVar
+import metrics
+import mp3
+import read_cache
+import tracing
+
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
+# File I/O from async code runs here, off the event loop
+STORAGE_THREADS = int(os.getenv('STORAGE_THREADS', '4'))
+_executor = ThreadPoolExecutor(max_workers=STORAGE_THREADS, thread_name_prefix='storage')
+
+# How many chapter texts and summaries to keep in memory
+TEXT_CACHE_SIZE = int(os.getenv('TEXT_CACHE_SIZE', '256'))
+
+# (path, mtime_ns, size) -> text; a rewritten file gets a new key
+_text_cache: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_text_cache_lock = threading.Lock()
+
+MANIFEST_VERSION = 1
+
+# Manifest entry kind -> file name inside a chapter's directory
+CHAPTER_FILES = {
+    'text': 'text.md',
+    'summary': 'summary.md',
+    'audio': 'audio.mp3',
+}
+
+# (story id, lock name) pairs the current thread holds, for re-entry
+_held_locks = threading.local()
+
+# Path helpers only resolve paths; directories are created when writing
 
 def get_user_data_dir() -> Path:
-    """Get the user data directory, creating it if it doesn't exist."""
-    data_dir = Path(os.getenv('USER_DATA_DIR'))
-    data_dir.mkdir(parents=True, exist_ok=True)
-    return data_dir
+    """Get the user data directory."""
+    return Path(os.getenv('USER_DATA_DIR'))
 
 def get_story_dir(story_id: str) -> Path:
-    """Get the directory for a specific story, creating it if it doesn't exist."""
-    story_dir = get_user_data_dir() / 'story' / story_id
-    story_dir.mkdir(parents=True, exist_ok=True)
-    return story_dir
+    """Get the directory for a specific story."""
+    return get_user_data_dir() / 'story' / story_id
 
 def get_chapter_dir(story_id: str, chapter_number: int) -> Path:
-    """Get the directory for a specific chapter, creating it if it doesn't exist."""
-    chapter_dir = get_story_dir(story_id) / 'chapter' / str(chapter_number)
-    chapter_dir.mkdir(parents=True, exist_ok=True)
-    return chapter_dir
+    """Get the directory for a specific chapter."""
+    return get_story_dir(story_id) / 'chapter' / str(chapter_number)
 
 def get_chapter_text_path(story_id: str, chapter_number: int) -> Path:
     """Get the path to the chapter's text file."""
     return get_chapter_dir(story_id, chapter_number) / 'text.md'
 
+def get_chapter_summary_path(story_id: str, chapter_number: int) -> Path:
+    """Get the path to the chapter's summary file."""
+    return get_chapter_dir(story_id, chapter_number) / 'summary.md'
+
 def get_chapter_audio_path(story_id: str, chapter_number: int) -> Path:
     """Get the path to the chapter's audio file."""
     return get_chapter_dir(story_id, chapter_number) / 'audio.mp3'
 
+def get_chapter_chunks_path(story_id: str, chapter_number: int) -> Path:
+    """Get the path to the chapter's list of TTS chunk hashes."""
+    return get_chapter_dir(story_id, chapter_number) / 'chunks.json'
+
+def get_tts_cache_dir() -> Path:
+    """Get the directory of cached TTS results, shared by all stories."""
+    return get_user_data_dir() / 'tts-cache'
+
+def get_story_manifest_path(story_id: str) -> Path:
+    """Get the path to the story's file manifest."""
+    return get_story_dir(story_id) / 'manifest.json'
+
+def prepare_write(path: Path) -> Path:
+    """Create the directories a file is about to be written into."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+async def run_io(func: Callable[..., T], *args) -> T:
+    """Run a blocking storage call on the storage thread pool."""
+    loop = asyncio.get_running_loop()
+    # Carry the current trace span over to the pool thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args))
+
+def write_atomic(path: Path, data: bytes) -> None:
+    """Write a file so that it is either fully there or not changed at all.
+
+    Data goes to a temp file in the same directory, is fsync'd and renamed
+    over the target, so a crash never leaves a truncated file behind.
+    """
+    with tracing.span('storage_write', path=path.as_posix(), bytes=len(data)), \
+            metrics.STORAGE_SECONDS.time(operation='write'):
+        prepare_write(path)
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        # Make the rename itself durable
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    metrics.STORAGE_BYTES.inc(len(data), operation='write')
+
+def get_file_version(path: Path) -> Optional[str]:
+    """A short token that changes whenever the file is rewritten."""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def file_stamp(path: Path) -> Optional[Dict[str, int]]:
+    """The size and mtime recorded for a file in the manifest."""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def stamp_version(stamp: Optional[Dict[str, int]]) -> Optional[str]:
+    """The get_file_version token for a manifest stamp."""
+    if not stamp:
+        return None
+    return f"{stamp['mtime_ns']:x}-{stamp['size']:x}"
+
+def read_text_cached(path: Path) -> Optional[str]:
+    """Read a text file through the in-process LRU cache, or None if it doesn't exist.
+
+    Entries are keyed on the file's mtime and size, so a rewritten file is
+    read again and its stale entry is eventually evicted.
+    """
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    with _text_cache_lock:
+        text = _text_cache.get(key)
+        if text is not None:
+            _text_cache.move_to_end(key)
+            metrics.TEXT_CACHE_LOOKUPS.inc(result='hit')
+            return text
+
+    metrics.TEXT_CACHE_LOOKUPS.inc(result='miss')
+    try:
+        with metrics.STORAGE_SECONDS.time(operation='read'):
+            text = path.read_text(encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    metrics.STORAGE_BYTES.inc(stat.st_size, operation='read')
+    with _text_cache_lock:
+        _text_cache[key] = text
+        while len(_text_cache) > TEXT_CACHE_SIZE:
+            _text_cache.popitem(last=False)
+    return text
+
+def read_bytes(path: Path) -> Optional[bytes]:
+    """Read a whole binary file, or None if it doesn't exist."""
+    try:
+        with metrics.STORAGE_SECONDS.time(operation='read'):
+            data = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    metrics.STORAGE_BYTES.inc(len(data), operation='read')
+    return data
+
+def scan_story_manifest(story_id: str) -> Dict[str, Any]:
+    """Build a story's manifest from what is on disk."""
+    manifest: Dict[str, Any] = {'version': MANIFEST_VERSION, 'chapters': {}}
+    chapters_dir = get_story_dir(story_id) / 'chapter'
+    if chapters_dir.is_dir():
+        for chapter_dir in chapters_dir.iterdir():
+            if not chapter_dir.name.isdigit():
+                continue
+            files = {kind: file_stamp(chapter_dir / name) for kind, name in CHAPTER_FILES.items()}
+            files = {kind: stamp for kind, stamp in files.items() if stamp}
+            if files:
+                manifest['chapters'][chapter_dir.name] = files
+    audiobook = file_stamp(get_audiobook_path(story_id))
+    if audiobook:
+        manifest['audiobook'] = audiobook
+    return manifest
+
+def write_story_manifest(story_id: str, manifest: Dict[str, Any]) -> None:
+    """Replace the manifest atomically so readers never see a partial file."""
+    write_atomic(get_story_manifest_path(story_id), json.dumps(manifest, indent=2).encode('utf-8'))
+
+@contextmanager
+def story_lock(story_id: str, name: str) -> Iterator[None]:
+    """Hold one of a story's named locks, against other threads and worker processes.
+
+    Each holder opens the lock file itself, and flock locks separate opens
+    of a file against each other, so threads queue up as processes do.
+    Re-entrant within a thread.
+    """
+    held = _held_locks.__dict__.setdefault('keys', set())
+    key = (story_id, name)
+    if key in held:
+        yield
+        return
+    path = get_story_dir(story_id) / f'{name}.lock'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'ab') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        held.add(key)
+        try:
+            yield
+        finally:
+            # Closing the file releases the lock
+            held.discard(key)
+
+@contextmanager
+def manifest_lock(story_id: str) -> Iterator[None]:
+    """Hold the story's manifest for a read-modify-write.
+
+    Re-entrant, so a locked update can read the manifest through
+    get_story_manifest.
+    """
+    with story_lock(story_id, 'manifest'):
+        yield
+
+def read_story_manifest(story_id: str) -> Optional[Dict[str, Any]]:
+    """The story's manifest as last written, or None if it's missing or unreadable."""
+    text = read_text_cached(get_story_manifest_path(story_id))
+    if text:
+        try:
+            manifest = json.loads(text)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest
+        except ValueError:
+            logger.warning("Rebuilding unreadable manifest for %s", story_id)
+    return None
+
+def get_story_manifest(story_id: str) -> Dict[str, Any]:
+    """Which chapter files a story has, with their sizes and mtimes.
+
+    Stories written before the manifest existed get one built from a scan
+    of their directory on first read.
+    """
+    manifest = read_story_manifest(story_id)
+    if manifest is not None:
+        return manifest
+    if not get_story_dir(story_id).is_dir():
+        return scan_story_manifest(story_id)
+
+    with manifest_lock(story_id):
+        # Another process may have written it while this one waited
+        manifest = read_story_manifest(story_id)
+        if manifest is None:
+            manifest = scan_story_manifest(story_id)
+            write_story_manifest(story_id, manifest)
+    return manifest
+
+def record_file(story_id: str, chapter_number: Optional[int], kind: str,
+                audio: Optional[mp3.AudioInfo] = None) -> None:
+    """Update the manifest entry for a file that was just written or removed.
+
+    ``chapter_number`` None means the story's audiobook. For audio files,
+    the probed ``audio`` details are kept alongside the stamp.
+    """
+    with manifest_lock(story_id):
+        manifest = get_story_manifest(story_id)
+        if chapter_number is None:
+            stamp = file_stamp(get_audiobook_path(story_id))
+            if stamp and audio:
+                stamp.update(dataclasses.asdict(audio))
+            if stamp:
+                manifest['audiobook'] = stamp
+            else:
+                manifest.pop('audiobook', None)
+        else:
+            path = get_chapter_dir(story_id, chapter_number) / CHAPTER_FILES[kind]
+            stamp = file_stamp(path)
+            if stamp and audio:
+                stamp.update(dataclasses.asdict(audio))
+            files = manifest['chapters'].setdefault(str(chapter_number), {})
+            if stamp:
+                files[kind] = stamp
+            else:
+                files.pop(kind, None)
+        write_story_manifest(story_id, manifest)
+    if kind in ('audio', 'audiobook'):
+        # The chapters list shows what audio exists
+        read_cache.invalidate_story(story_id)
+
+def get_chapter_files(story_id: str, chapter_number: int) -> Dict[str, Dict[str, int]]:
+    """Manifest stamps for one chapter's files, keyed by kind."""
+    return get_story_manifest(story_id)['chapters'].get(str(chapter_number), {})
+
 def save_chapter_text(story_id: str, chapter_number: int, content: str) -> None:
     """Save chapter text to file."""
-    text_path = get_chapter_text_path(story_id, chapter_number)
-    text_path.write_text(content, encoding='utf-8')
+    write_atomic(get_chapter_text_path(story_id, chapter_number), content.encode('utf-8'))
+    record_file(story_id, chapter_number, 'text')
+
+def save_chapter_summary(story_id: str, chapter_number: int, summary: str) -> None:
+    """Save chapter summary to file."""
+    write_atomic(get_chapter_summary_path(story_id, chapter_number), summary.encode('utf-8'))
+    record_file(story_id, chapter_number, 'summary')
+
+def get_chapter_summary(story_id: str, chapter_number: int) -> Optional[str]:
+    """Get chapter summary from file."""
+    return read_text_cached(get_chapter_summary_path(story_id, chapter_number))
 
-def save_chapter_audio(story_id: str, chapter_number: int, audio_data: bytes) -> None:
-    """Save chapter audio to file."""
-    audio_path = get_chapter_audio_path(story_id, chapter_number)
-    audio_path.write_bytes(audio_data)
+def save_chapter_audio(story_id: str, chapter_number: int, audio_data: bytes) -> mp3.AudioInfo:
+    """Save chapter audio to file, recording its length and format in the manifest."""
+    audio = mp3.probe(audio_data)
+    write_atomic(get_chapter_audio_path(story_id, chapter_number), audio_data)
+    record_file(story_id, chapter_number, 'audio', audio)
+    return audio
 
 def get_chapter_text(story_id: str, chapter_number: int) -> Optional[str]:
     """Get chapter text from file."""
-    text_path = get_chapter_text_path(story_id, chapter_number)
-    if text_path.exists():
-        return text_path.read_text(encoding='utf-8')
-    return None
+    return read_text_cached(get_chapter_text_path(story_id, chapter_number))
 
 def get_chapter_audio(story_id: str, chapter_number: int) -> Optional[bytes]:
     """Get chapter audio from file."""
-    audio_path = get_chapter_audio_path(story_id, chapter_number)
-    if audio_path.exists():
-        return audio_path.read_bytes()
-    return None
+    return read_bytes(get_chapter_audio_path(story_id, chapter_number))
 
 def has_chapter_audio(story_id: str, chapter_number: int) -> bool:
     """Check if chapter has audio file."""
-    return get_chapter_audio_path(story_id, chapter_number).exists()
+    return 'audio' in get_chapter_files(story_id, chapter_number)
+
+def get_chapter_audio_version(story_id: str, chapter_number: int) -> Optional[str]:
+    """Version token of the chapter's audio, from the manifest."""
+    return stamp_version(get_chapter_files(story_id, chapter_number).get('audio'))
+
+def audio_info(stamp: Optional[Dict[str, Any]]) -> Optional[mp3.AudioInfo]:
+    """The probed details in a manifest stamp, if they were recorded when the file was saved."""
+    if not stamp or 'sha256' not in stamp:
+        return None
+    return mp3.AudioInfo(**{field.name: stamp[field.name] for field in dataclasses.fields(mp3.AudioInfo)})
+
+def get_chapter_audio_info(story_id: str, chapter_number: int) -> Optional[mp3.AudioInfo]:
+    """Length and format of the chapter's audio, from the manifest."""
+    return audio_info(get_chapter_files(story_id, chapter_number).get('audio'))
 
 def get_audiobook_path(story_id: str) -> Path:
     """Get the path to the audiobook file."""
     return get_story_dir(story_id) / "audiobook.mp3"
 
+def get_audiobook_manifest_path(story_id: str) -> Path:
+    """Get the path to the audiobook's chapter manifest."""
+    return get_story_dir(story_id) / "audiobook.json"
+
 def has_audiobook(story_id: str) -> bool:
     """Check if an audiobook exists for this story."""
-    path = get_audiobook_path(story_id)
-    exists = path.exists()
-    print(f"Checking audiobook at {path}: {exists}")
-    return exists
+    return 'audiobook' in get_story_manifest(story_id)
+
+def get_audiobook_version(story_id: str) -> Optional[str]:
+    """Version token of the audiobook, from the manifest."""
+    return stamp_version(get_story_manifest(story_id).get('audiobook'))
+
+def get_audiobook_info(story_id: str) -> Optional[mp3.AudioInfo]:
+    """Length and format of the audiobook, from the manifest."""
+    return audio_info(get_story_manifest(story_id).get('audiobook'))
 
 def save_audiobook(story_id: str, audio_data: bytes) -> None:
-    """Save the audiobook to disk."""
-    path = get_audiobook_path(story_id)
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_bytes(audio_data)
+    """Save the audiobook to disk, recording its length and format in the manifest."""
+    audio = mp3.probe(audio_data)
+    write_atomic(get_audiobook_path(story_id), audio_data)
+    record_file(story_id, None, 'audiobook', audio)
 
 def get_audiobook(story_id: str) -> Optional[bytes]:
     """Get the audiobook data if it exists."""
-    path = get_audiobook_path(story_id)
-    if path.exists():
-        return path.read_bytes()
-    return None 
\ No newline at end of file
+    return read_bytes(get_audiobook_path(story_id))
+
+# Async API: the same operations, run on the storage thread pool
+
+async def save_chapter_text_async(story_id: str, chapter_number: int, content: str) -> None:
+    await run_io(save_chapter_text, story_id, chapter_number, content)
+
+async def save_chapter_summary_async(story_id: str, chapter_number: int, summary: str) -> None:
+    await run_io(save_chapter_summary, story_id, chapter_number, summary)
+
+async def save_chapter_audio_async(story_id: str, chapter_number: int, audio_data: bytes) -> mp3.AudioInfo:
+    return await run_io(save_chapter_audio, story_id, chapter_number, audio_data)
+
+async def save_audiobook_async(story_id: str, audio_data: bytes) -> None:
+    await run_io(save_audiobook, story_id, audio_data)
+
+async def get_chapter_text_async(story_id: str, chapter_number: int) -> Optional[str]:
+    return await run_io(get_chapter_text, story_id, chapter_number)
+
+async def get_chapter_summary_async(story_id: str, chapter_number: int) -> Optional[str]:
+    return await run_io(get_chapter_summary, story_id, chapter_number)
+
+async def get_chapter_audio_async(story_id: str, chapter_number: int) -> Optional[bytes]:
+    # Whole-file read: only the re-encode fallback uses this, and decoding needs all of it anyway
+    return await run_io(get_chapter_audio, story_id, chapter_number)
+
+async def get_chapter_files_async(story_id: str, chapter_number: int) -> Dict[str, Dict[str, int]]:
+    return await run_io(get_chapter_files, story_id, chapter_number)
+
+async def has_chapter_audio_async(story_id: str, chapter_number: int) -> bool:
+    return await run_io(has_chapter_audio, story_id, chapter_number)
+
+async def get_chapter_audio_version_async(story_id: str, chapter_number: int) -> Optional[str]:
+    return await run_io(get_chapter_audio_version, story_id, chapter_number)
+
+async def get_chapter_audio_info_async(story_id: str, chapter_number: int) -> Optional[mp3.AudioInfo]:
+    return await run_io(get_chapter_audio_info, story_id, chapter_number)
+
+async def has_audiobook_async(story_id: str) -> bool:
+    return await run_io(has_audiobook, story_id)
+
+async def get_audiobook_version_async(story_id: str) -> Optional[str]:
+    return await run_io(get_audiobook_version, story_id)
+
+async def get_audiobook_info_async(story_id: str) -> Optional[mp3.AudioInfo]:
+    return await run_io(get_audiobook_info, story_id)
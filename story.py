@@ -1,5 +1,10 @@
+import logging
 from datetime import datetime
 from typing import Optional, Tuple, List, Dict, Any
+import chapter
+import read_cache
+
+logger = logging.getLogger(__name__)
 
 async def get_story(db, story_id: str) -> Optional[Dict[str, Any]]:
     """Get a single story's details."""
@@ -21,11 +26,40 @@ async def get_story(db, story_id: str) -> Optional[Dict[str, Any]]:
 
         return story[0]["result"][0]
     except Exception as e:
-        print("Error fetching story:", e)
+        logger.error("Error fetching story: %s", e)
+        return None
+
+async def get_story_with_chapters(db, story_id: str) -> Optional[Dict[str, Any]]:
+    """Get a story with its chapters in order, including their audio status, in one query."""
+    story = await db.query('''
+        SELECT
+            id,
+            title,
+            prompt,
+            num_chapters,
+            words_per_chapter,
+            (
+                SELECT
+                    chapter_number,
+                    created_at,
+                    audio_size != NONE AS has_audio,
+                    audio_size,
+                    audio_duration_ms
+                FROM chapter
+                WHERE story = $parent.id
+                ORDER BY chapter_number
+            ) AS chapters
+        FROM type::thing('story', $story_id);
+    ''', {
+        'story_id': story_id
+    })
+
+    if not story or story[0]["status"] == "ERR" or not story[0]["result"]:
         return None
+    return story[0]["result"][0]
 
-async def get_recent_stories(db, limit: int = 10) -> List[Dict[str, Any]]:
-    """Get a list of recent stories."""
+async def get_recent_stories(db, limit: int = 10) -> Optional[List[Dict[str, Any]]]:
+    """Get a list of recent stories, or None if the database couldn't be read."""
     try:
         stories = await db.query('''
             SELECT 
@@ -43,14 +77,15 @@ async def get_recent_stories(db, limit: int = 10) -> List[Dict[str, Any]]:
         })
         return stories[0]["result"] if stories[0]["result"] else []
     except Exception as e:
-        print("Error fetching recent stories:", e)
-        return []
+        logger.error("Error fetching recent stories: %s", e)
+        return None
 
 async def create_story(
     db,
     prompt: str,
     total_chapters: int = 10,
-    words_per_chapter: int = 1000
+    words_per_chapter: int = 1000,
+    context_tokens: int = chapter.CONTEXT_TOKEN_BUDGET
 ) -> Tuple[Optional[str], Optional[str]]:
     """Create a new story and return its ID."""
     try:
@@ -64,13 +99,15 @@ async def create_story(
                 created_at = $now,
                 updated_at = $now,
                 num_chapters = $total_chapters,
-                words_per_chapter = $words_per_chapter
+                words_per_chapter = $words_per_chapter,
+                context_tokens = $context_tokens
             RETURN id;
         ''', {
             'prompt': prompt,
             'now': now,
             'total_chapters': total_chapters,
-            'words_per_chapter': words_per_chapter
+            'words_per_chapter': words_per_chapter,
+            'context_tokens': context_tokens
         })
         
         if result[0]["status"] == "ERR":
@@ -78,10 +115,11 @@ async def create_story(
         
         # Strip the 'story:' prefix from the ID
         story_id = str(result[0]["result"][0]["id"]).split(':')[1]
+        read_cache.invalidate(read_cache.HOME)
         return story_id, None
 
     except Exception as e:
-        print("Error creating story:", e)
+        logger.error("Error creating story: %s", e)
         return None, str(e)
 
 async def delete_story(db, story_id: str) -> Tuple[bool, Optional[str]]:
@@ -105,9 +143,13 @@ async def delete_story(db, story_id: str) -> Tuple[bool, Optional[str]]:
         return True, None
 
     except Exception as e:
-        print("Error deleting story:", e)
+        logger.error("Error deleting story: %s", e)
         return False, str(e)
 
+    finally:
+        # Even a half-finished delete changes what the story's pages show
+        read_cache.invalidate_story(story_id)
+
 async def get_story_chapters(db, story_id: str) -> List[Dict[str, Any]]:
     """Get all chapters for a story."""
     try:
@@ -122,5 +164,5 @@ async def get_story_chapters(db, story_id: str) -> List[Dict[str, Any]]:
 
         return chapters[0]["result"] if chapters[0]["result"] else []
     except Exception as e:
-        print("Error fetching story chapters:", e)
+        logger.error("Error fetching story chapters: %s", e)
         return [] 
\ No newline at end of file
@@ -0,0 +1,131 @@
+"""Property tests for the TTS chunker, checked against oracles that don't use its code.
+
+    python -m unittest discover tests
+"""
+import random
+import re
+import unittest
+from typing import List, Tuple
+import bench_chunking
+import tts_text
+
+WORDS = (
+    "the storm rolled over hills while she waited by old door and listened for "
+    "footsteps in dark hall where lantern light flickered against stone walls"
+).split()
+# Mid-sentence abbreviations, which must not end a sentence
+TITLES = ["Dr. Ellis", "Mr. Hale", "Mrs. Reyes"]
+ENDINGS = ['.', '?', '!', '...', '…']
+MARKDOWN = re.compile(r'\*\*|__|~~|`|^#|\]\(|<[a-z]', re.MULTILINE)
+
+SEEDS = range(40)
+
+
+def make_sentence(rng: random.Random, words: int) -> str:
+    parts = [rng.choice(WORDS) for _ in range(words)]
+    if rng.random() < 0.3:
+        parts.insert(rng.randrange(len(parts)), rng.choice(TITLES))
+    text = ' '.join(parts)
+    return text[0].upper() + text[1:] + rng.choice(ENDINGS)
+
+
+def make_story(rng: random.Random, paragraphs: int, max_words: int) -> List[List[str]]:
+    """Paragraphs of sentences, in plain text, so the true sentence boundaries are known."""
+    return [
+        [make_sentence(rng, rng.randint(1, max_words)) for _ in range(rng.randint(1, 6))]
+        for _ in range(paragraphs)
+    ]
+
+
+def to_text(story: List[List[str]]) -> str:
+    return '\n\n'.join(' '.join(paragraph) for paragraph in story)
+
+
+def fewest_chunks(story: List[List[str]], max_length: int) -> int:
+    """The optimum, by dynamic programming over every way to cut the sentences into chunks."""
+    units: List[Tuple[int, int]] = []  # (separator length, sentence length)
+    for paragraph in story:
+        for i, sentence in enumerate(paragraph):
+            units.append((2 if i == 0 else 1, len(sentence)))
+    best = [0] + [len(units) + 1] * len(units)
+    for end in range(1, len(units) + 1):
+        # Grow the last chunk backwards from sentence end - 1
+        length = 0
+        for start in range(end - 1, -1, -1):
+            length += units[start][1] + (units[start + 1][0] if start + 1 < end else 0)
+            if length > max_length:
+                break
+            best[end] = min(best[end], best[start] + 1)
+    return best[-1]
+
+
+def chunk_word_ends(chunks: List[str]) -> List[int]:
+    """How many words have been spoken at the end of each chunk."""
+    ends, total = [], 0
+    for chunk in chunks:
+        total += len(chunk.split())
+        ends.append(total)
+    return ends
+
+
+class ChunkTextProperties(unittest.TestCase):
+
+    def test_chunks_fit_the_limit_and_have_no_markdown(self):
+        for seed in SEEDS:
+            rng = random.Random(seed)
+            chunks = tts_text.chunk_text(bench_chunking.chapter(rng, 3000))
+            for chunk in chunks:
+                self.assertGreater(len(chunk), 0)
+                self.assertLessEqual(len(chunk), tts_text.CHUNK_MAX_CHARS)
+                self.assertIsNone(MARKDOWN.search(chunk), chunk[:80])
+
+    def test_every_word_is_spoken_once_in_order(self):
+        for seed in SEEDS:
+            story = make_story(random.Random(seed), 30, 60)
+            chunks = tts_text.chunk_text(to_text(story), 300)
+            self.assertEqual(' '.join(chunks).split(), to_text(story).split())
+
+    def test_chunks_break_only_between_sentences(self):
+        for seed in SEEDS:
+            story = make_story(random.Random(seed), 30, 40)
+            sentences = [sentence for paragraph in story for sentence in paragraph]
+            boundaries, total = set(), 0
+            for sentence in sentences:
+                total += len(sentence.split())
+                boundaries.add(total)
+            chunks = tts_text.chunk_text(to_text(story), 300)
+            for end in chunk_word_ends(chunks):
+                self.assertIn(end, boundaries, f"seed {seed}: chunk ends mid-sentence")
+
+    def test_long_sentences_are_broken_only_where_they_must_be(self):
+        for seed in SEEDS:
+            rng = random.Random(seed)
+            story = make_story(rng, 10, 40)
+            run_on = ', '.join(make_sentence(rng, 12)[:-1] for _ in range(12)) + '.'
+            story[rng.randrange(len(story))].append(run_on)
+            spans, total = [], 0
+            for sentence in (s for paragraph in story for s in paragraph):
+                spans.append((total, total + len(sentence.split()), len(sentence)))
+                total += len(sentence.split())
+
+            chunks = tts_text.chunk_text(to_text(story), 300)
+            self.assertTrue(all(len(chunk) <= 300 for chunk in chunks))
+            for end in chunk_word_ends(chunks):
+                inside = [length for start, stop, length in spans if start < end < stop]
+                self.assertTrue(all(length > 300 for length in inside), f"seed {seed}: needless break")
+
+    def test_chunk_count_is_the_fewest_possible(self):
+        for seed in SEEDS:
+            story = make_story(random.Random(seed), 30, 40)
+            chunks = tts_text.chunk_text(to_text(story), 300)
+            self.assertEqual(len(chunks), fewest_chunks(story, 300), f"seed {seed}")
+
+    def test_chunks_are_packed_from_speech_units(self):
+        for seed in SEEDS:
+            text = bench_chunking.chapter(random.Random(seed), 2000)
+            units, _ = tts_text.speech_units(text)
+            self.assertEqual(' '.join(tts_text.chunk_text(text)).split(), ' '.join(units).split())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Share of traces that are written out; the decision is made once per trace
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+# Defaults to traces.jsonl in USER_DATA_DIR; rotated by size
+TRACE_FILE = os.getenv('TRACE_FILE')
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_MB', '20')) * 1024 * 1024
+TRACE_FILE_BACKUPS = int(os.getenv('TRACE_FILE_BACKUPS', '5'))
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'text' for people, 'json' for log shippers
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+
+SERVICE_NAME = 'storymode'
+
+# OTLP span kinds and status codes
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    """One timed unit of work within a trace."""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_span_id', 'kind', 'sampled',
+                 'start_ns', 'end_ns', 'attributes', 'status', 'status_message', 'token')
+
+    def __init__(self, name: str, parent: Optional["Span"], kind: int, attributes: Dict[str, Any]) -> None:
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent else ''
+        self.kind = kind
+        self.sampled = parent.sampled if parent else random.random() < TRACE_SAMPLE_RATE
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.status = STATUS_OK
+        self.status_message = ''
+        self.token: Optional[contextvars.Token] = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def fail(self, error: BaseException) -> None:
+        self.status = STATUS_ERROR
+        self.status_message = f"{type(error).__name__}: {error}"
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """The span in OTLP/JSON shape, with its resource inlined."""
+        return {
+            "resource": {"attributes": [otlp_attribute('service.name', SERVICE_NAME)]},
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [otlp_attribute(key, value) for key, value in self.attributes.items() if value is not None],
+            "status": {"code": self.status, "message": self.status_message},
+        }
+
+
+def otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('span', default=None)
+_exporter: Optional[logging.Logger] = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> logging.Logger:
+    """A logger writing one span per line to the rotating trace file."""
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            path = Path(TRACE_FILE or Path(os.getenv('USER_DATA_DIR', '.')) / 'traces.jsonl')
+            path.parent.mkdir(parents=True, exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=TRACE_FILE_MAX_BYTES, backupCount=TRACE_FILE_BACKUPS, encoding='utf-8', delay=True
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            exporter = logging.getLogger('storymode.traces')
+            exporter.addHandler(handler)
+            exporter.setLevel(logging.INFO)
+            exporter.propagate = False
+            _exporter = exporter
+        return _exporter
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+def current_ids() -> Tuple[str, str]:
+    """(trace id, span id) of the current span, or empty strings outside one."""
+    span = _current.get()
+    return (span.trace_id, span.span_id) if span else ('', '')
+
+
+def start(name: str, span_kind: int = KIND_INTERNAL, **attributes) -> Span:
+    """Start a span as the current one; pair with finish. Prefer the span() block."""
+    span = Span(name, _current.get(), span_kind, attributes)
+    span.token = _current.set(span)
+    return span
+
+
+def finish(span: Span, error: Optional[BaseException] = None) -> None:
+    if span.end_ns:
+        return
+    span.end_ns = time.time_ns()
+    if error is not None:
+        span.fail(error)
+    try:
+        _current.reset(span.token)
+    except ValueError:
+        # Ended from another context, e.g. an async generator closed elsewhere
+        pass
+    if span.sampled:
+        get_exporter().info(json.dumps(span.to_otlp()))
+
+
+@contextmanager
+def span(name: str, span_kind: int = KIND_INTERNAL, **attributes) -> Iterator[Span]:
+    """Time the block as a child of the current span, or as a new trace."""
+    current_span = start(name, span_kind, **attributes)
+    try:
+        yield current_span
+    except BaseException as e:
+        finish(current_span, e)
+        raise
+    finish(current_span)
+
+
+# Attributes every LogRecord has; anything else was passed in ``extra``
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'trace_id', 'span_id'}
+
+
+class TraceContextFilter(logging.Filter):
+    """Stamp each record with the trace and span it was logged under."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id, record.span_id = current_ids()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with ``extra`` fields kept as keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "trace_id": getattr(record, 'trace_id', ''),
+            "span_id": getattr(record, 'span_id', ''),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_FIELDS)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = ' '.join(f"{key}={value}" for key, value in vars(record).items() if key not in _RECORD_FIELDS)
+        return f"{line} {fields}" if fields else line
+
+
+def configure_logging() -> None:
+    """Send application logs to stderr at LOG_LEVEL, as text or JSON."""
+    handler = logging.StreamHandler(sys.stderr)
+    handler.addFilter(TraceContextFilter())
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter('%(asctime)s %(levelname)s %(name)s [%(trace_id).8s] %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import unicodedata
+from pathlib import Path
+from typing import List, Optional, Set
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Total size the cache may grow to before least recently used entries go
+TTS_CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_MB', '1024')) * 1024 * 1024
+
+
+def normalize_text(text: str) -> str:
+    """Collapse differences that don't change what TTS reads out."""
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def chunk_key(text: str, voice: str, model: str, response_format: str) -> str:
+    """Content hash identifying one synthesized chunk."""
+    payload = json.dumps([normalize_text(text), voice, model, response_format])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_entry_path(key: str) -> Path:
+    return storage.get_tts_cache_dir() / key[:2] / f"{key}.mp3"
+
+
+def get(key: str) -> Optional[bytes]:
+    """Cached audio for a chunk, or None. A hit counts as a use for eviction."""
+    path = get_entry_path(key)
+    try:
+        data = path.read_bytes()
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return data
+
+
+def put(key: str, data: bytes) -> None:
+    storage.write_atomic(get_entry_path(key), data)
+
+
+def save_chunk_manifest(story_id: str, chapter_number: int, keys: List[str]) -> None:
+    """Record which chunks the chapter's audio was built from.
+
+    Reuse doesn't depend on this: chunks are found by their content hash,
+    wherever they were first synthesized. The manifest only tells evict
+    which entries are still in use, so those go last.
+    """
+    path = storage.get_chapter_chunks_path(story_id, chapter_number)
+    storage.write_atomic(path, json.dumps({"chunks": keys}, indent=2).encode('utf-8'))
+
+
+def referenced_keys() -> Set[str]:
+    """Hashes used by some chapter's current audio."""
+    keys: Set[str] = set()
+    for path in (storage.get_user_data_dir() / 'story').glob('*/chapter/*/chunks.json'):
+        try:
+            keys.update(json.loads(path.read_text(encoding='utf-8'))["chunks"])
+        except (OSError, ValueError, KeyError):
+            continue
+    return keys
+
+
+def evict(max_bytes: int = TTS_CACHE_MAX_BYTES) -> int:
+    """Delete least recently used entries until the cache fits in max_bytes.
+
+    Chunks that no chapter refers to any more go first. Returns the number
+    of bytes freed.
+    """
+    entries = []
+    for path in storage.get_tts_cache_dir().glob('*/*.mp3'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((path, stat.st_size, stat.st_mtime_ns))
+
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return 0
+
+    referenced = referenced_keys()
+    entries.sort(key=lambda entry: (entry[0].stem in referenced, entry[2]))
+    freed = 0
+    for path, size, _ in entries:
+        if total - freed <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        freed += size
+    logger.info("Evicted %d bytes from the TTS cache", freed)
+    return freed
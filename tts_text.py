@@ -0,0 +1,179 @@
+import re
+from typing import Iterator, List, Tuple
+
+# Chunk size we aim for, a little under OpenAI's 4096-character TTS limit
+CHUNK_MAX_CHARS = 4000
+
+PARAGRAPH_SEPARATOR = '\n\n'
+SENTENCE_SEPARATOR = ' '
+
+# Words ending in a period that don't end a sentence
+ABBREVIATIONS = {
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'st', 'sr', 'jr', 'mt', 'capt', 'col', 'gen', 'lt', 'sgt',
+    'rev', 'vs', 'etc', 'e.g', 'i.e', 'approx', 'no', 'vol', 'fig',
+}
+
+FENCE = re.compile(r'^\s*(```|~~~)')
+HEADING = re.compile(r'^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$')
+# A line that is all bold, used as a title
+BOLD_LINE = re.compile(r'^\s*(\*\*|__)(.+?)\1\s*$')
+RULE = re.compile(r'^\s{0,3}([-*_])(\s*\1){2,}\s*$')
+BLOCKQUOTE = re.compile(r'^\s{0,3}>\s?')
+LIST_ITEM = re.compile(r'^\s*(?:[-*+]|\d+[.)])\s+')
+IMAGE = re.compile(r'!\[([^\]]*)\]\([^)]*\)')
+LINK = re.compile(r'\[([^\]]+)\]\([^)]*\)')
+HTML_TAG = re.compile(r'</?[A-Za-z][^>]*>')
+INLINE_CODE = re.compile(r'`+([^`]*)`+')
+EMPHASIS = [
+    re.compile(r'\*\*(.+?)\*\*'),
+    re.compile(r'(?<!\w)__(.+?)__(?!\w)'),
+    re.compile(r'~~(.+?)~~'),
+    re.compile(r'(?<![\w*])\*(?!\s)(.+?)(?<!\s)\*(?![\w*])'),
+    re.compile(r'(?<!\w)_(?!\s)(.+?)(?<!\s)_(?!\w)'),
+]
+
+# Sentence-ending punctuation, any closing quotes or brackets, then the
+# space before a new sentence (which must start like one)
+SENTENCE_END = re.compile(r'(?:[.!?]+|…)["\'”’)\]]*\s+(?=["\'“‘(\[]?[A-Z0-9])')
+CLAUSE_END = re.compile(r'[,;:—–]\s+')
+TERMINAL = ('.', '!', '?', '…', '"', "'", '”', '’', ')', ':')
+
+
+def strip_inline(text: str) -> str:
+    """Remove inline markdown, keeping the words."""
+    text = IMAGE.sub(r'\1', text)
+    text = LINK.sub(r'\1', text)
+    text = HTML_TAG.sub('', text)
+    text = INLINE_CODE.sub(r'\1', text)
+    for pattern in EMPHASIS:
+        text = pattern.sub(r'\1', text)
+    return text
+
+
+def markdown_to_speech(text: str) -> List[str]:
+    """Turn markdown into paragraphs of plain, speakable text.
+
+    Headings and lines that are all bold (like ``**Chapter One**``)
+    become their own paragraph ending in a full stop, so they're read as a
+    title with a pause after it.
+    """
+    paragraphs: List[str] = []
+    lines: List[str] = []
+
+    def end_paragraph() -> None:
+        paragraph = re.sub(r'\s+', ' ', ' '.join(lines)).strip()
+        if paragraph:
+            paragraphs.append(paragraph)
+        lines.clear()
+
+    for line in text.splitlines():
+        if FENCE.match(line) or RULE.match(line) or not line.strip():
+            end_paragraph()
+            continue
+
+        title_match = HEADING.match(line) or BOLD_LINE.match(line)
+        if title_match:
+            end_paragraph()
+            title = strip_inline(title_match.group(title_match.lastindex)).strip()
+            if title and not title.endswith(TERMINAL):
+                title += '.'
+            lines.append(title)
+            end_paragraph()
+            continue
+
+        line = BLOCKQUOTE.sub('', line)
+        if LIST_ITEM.match(line):
+            # Each list item is read as its own paragraph
+            end_paragraph()
+            line = LIST_ITEM.sub('', line)
+        lines.append(strip_inline(line))
+
+    end_paragraph()
+    return paragraphs
+
+
+def split_sentences(paragraph: str) -> List[str]:
+    """Split a paragraph into sentences, keeping their punctuation."""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(paragraph):
+        words = paragraph[start:match.start() + 1].split()
+        last_word = words[-1].rstrip('.').lower() if words else ''
+        if paragraph[match.start()] == '.' and last_word in ABBREVIATIONS:
+            continue
+        sentences.append(paragraph[start:match.end()].strip())
+        start = match.end()
+    if paragraph[start:].strip():
+        sentences.append(paragraph[start:].strip())
+    return sentences
+
+
+def split_long(sentence: str, max_length: int) -> Iterator[str]:
+    """Break a sentence that alone is over the limit: at clauses, then words, then anywhere."""
+    if len(sentence) <= max_length:
+        yield sentence
+        return
+
+    for pattern in (CLAUSE_END, re.compile(r'\s+')):
+        pieces = []
+        start = 0
+        for match in pattern.finditer(sentence):
+            pieces.append(sentence[start:match.end()].strip())
+            start = match.end()
+        pieces.append(sentence[start:].strip())
+        pieces = [piece for piece in pieces if piece]
+        if len(pieces) > 1:
+            for chunk in pack(pieces, [SENTENCE_SEPARATOR] * len(pieces), max_length):
+                yield from split_long(chunk, max_length)
+            return
+
+    for start in range(0, len(sentence), max_length):
+        yield sentence[start:start + max_length]
+
+
+def pack(units: List[str], separators: List[str], max_length: int) -> List[str]:
+    """Greedily pack units, in order, into as few chunks of at most max_length as possible.
+
+    ``separators[i]`` joins unit i to the one before it. Taking as much as
+    fits each time gives the fewest chunks for units kept in order.
+    """
+    chunks: List[str] = []
+    current = ''
+    for unit, separator in zip(units, separators):
+        if not current:
+            current = unit
+        elif len(current) + len(separator) + len(unit) <= max_length:
+            current += separator + unit
+        else:
+            chunks.append(current)
+            current = unit
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def speech_units(text: str, max_length: int = CHUNK_MAX_CHARS) -> Tuple[List[str], List[str]]:
+    """The pieces chunks are packed from, and the separator before each.
+
+    Pieces are whole sentences, except that a sentence over max_length is
+    broken up by split_long; the first piece of a paragraph is joined with
+    PARAGRAPH_SEPARATOR, the rest with SENTENCE_SEPARATOR.
+    """
+    units: List[str] = []
+    separators: List[str] = []
+    for paragraph in markdown_to_speech(text):
+        for i, sentence in enumerate(split_sentences(paragraph)):
+            for j, piece in enumerate(split_long(sentence, max_length)):
+                units.append(piece)
+                separators.append(PARAGRAPH_SEPARATOR if i == j == 0 else SENTENCE_SEPARATOR)
+    return units, separators
+
+
+def chunk_text(text: str, max_length: int = CHUNK_MAX_CHARS) -> List[str]:
+    """Turn chapter markdown into the fewest TTS-sized chunks of speakable text.
+
+    Chunks break between paragraphs or sentences where they can, and are
+    never longer than max_length.
+    """
+    units, separators = speech_units(text, max_length)
+    return pack(units, separators, max_length)